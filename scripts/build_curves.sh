@@ -18,9 +18,30 @@ else
   YEAR_SUFFIX=""
 fi
 
-export DATA_DIR YEAR_FILTER YEAR_SUFFIX
+# Raw rows: the key-deduplicated store (ivol-fetch --store / ivol-store) when
+# present, else the flat per-pull files in raw/ (overlapping pulls double count)
+if [ -d "$DATA_DIR/store/ivol" ]; then
+  RAW_SRC="read_parquet('${DATA_DIR}/store/ivol/*/*/*.parquet', hive_partitioning=true, union_by_name=true)"
+  # filter on the partition column so only year=${YEAR} files are opened
+  if [ -n "$YEAR" ]; then YEAR_FILTER="year = ${YEAR}"; fi
+else
+  RAW_SRC="read_parquet('${DATA_DIR}/raw/*.parquet')"
+fi
+
+export DATA_DIR YEAR_FILTER YEAR_SUFFIX RAW_SRC
+
+# DuckDB limits (the stage files no longer hardcode them); spills to disk
+# past the memory limit instead of failing
+DUCKDB_THREADS="${DUCKDB_THREADS:-$(nproc)}"
+DUCKDB_MEMORY_LIMIT="${DUCKDB_MEMORY_LIMIT:-}"  # e.g. 24GB; default 80% of RAM
+DUCKDB_TEMP_DIR="${DUCKDB_TEMP_DIR:-$DATA_DIR/tmp/duckdb}"
+mkdir -p "$DUCKDB_TEMP_DIR"
+SETTINGS="SET threads=${DUCKDB_THREADS}; SET temp_directory='${DUCKDB_TEMP_DIR}';"
+if [ -n "$DUCKDB_MEMORY_LIMIT" ]; then
+  SETTINGS="$SETTINGS SET memory_limit='${DUCKDB_MEMORY_LIMIT}';"
+fi
 
 for f in sql/01_pairs.sql sql/02_atm.sql sql/03_slope.sql sql/04_curve_header.sql; do
   echo ">>> running $f"
-  envsubst < "$f" | duckdb
+  { echo "$SETTINGS"; envsubst < "$f"; } | duckdb
 done
@@ -3,13 +3,21 @@ import os
 import sys
 import re
 import argparse
+import time
+import resource
+from datetime import date
 import traceback
+import multiprocessing as mp
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import polars as pl
+import pyarrow.parquet as pq
 
 # import the function you already have
 sys.path.append(str(Path(__file__).resolve().parents[1] / "src"))
-from rv_daily_polars import rv_daily_for_file  # type: ignore
+from rv_daily_polars import RV_VERSION, rv_daily_for_file, sink_rv  # type: ignore
+from manifest import Manifest, file_sha256, fingerprint  # type: ignore
 
 DATE_RE = re.compile(r"(\d{4}-\d{2}-\d{2})")
 
@@ -26,18 +34,200 @@ def extract_date(p: Path) -> str:
     return m.group(1)
 
 
-def do_one(infile: Path, out_root: Path, overwrite: bool) -> tuple[Path, str]:
+def period_of(date_str: str, group: str) -> str:
+    return {"day": date_str, "month": date_str[:7], "year": date_str[:4]}[group]
+
+
+def group_path(out_root: Path, period: str) -> Path:
+    # year-partitioned dataset: <out>/year=YYYY/rv_<period>.parquet
+    return out_root / f"year={period[:4]}" / f"rv_{period}.parquet"
+
+
+def source_of(files: list[Path], content_hash: bool = False) -> str:
+    """Fingerprint of the inputs: size + mtime, or their sha256 with --hash."""
+    if content_hash:
+        return fingerprint([file_sha256(f) for f in files])
+    sig = []
+    for f in files:
+        st = f.stat()
+        sig.append([f.name, st.st_size, st.st_mtime_ns])
+    return fingerprint(sig)
+
+
+def do_group(period: str, files: list[Path], out_root: Path):
+    """One job: all files of ``period`` scanned as a single lazy plan."""
+    try:
+        dst = group_path(out_root, period)
+        n = sink_rv(files, dst)
+        return (dst, f"OK   {period} -> {dst} ({len(files)} files, {n} rows)", n)
+    except Exception as e:
+        return (None, f"ERR  {period}: {e}\n{traceback.format_exc()}", 0)
+
+
+def do_one(infile: Path, out_root: Path):
     try:
         d = extract_date(infile)
         dst = out_path(out_root, d)
         dst.parent.mkdir(parents=True, exist_ok=True)
-        if dst.exists() and not overwrite:
-            return (infile, f"SKIP {d} (exists)")
         df = rv_daily_for_file(str(infile))  # returns all K (1/5/15/30) in one DF
         df.write_parquet(str(dst))
-        return (infile, f"OK   {d} -> {dst.name} ({df.shape[0]} rows)")
+        return (dst, f"OK   {d} -> {dst.name} ({df.shape[0]} rows)", df.shape[0])
     except Exception as e:
-        return (infile, f"ERR  {infile.name}: {e}\n{traceback.format_exc()}")
+        return (None, f"ERR  {infile.name}: {e}\n{traceback.format_exc()}", 0)
+
+
+def compact_daily(out_root: Path, kind: str, manifest: Manifest):
+    """Fold all_min<date> files into <out>/year=YYYY/rv_<period>.parquet.
+
+    Days already in a period file are replaced by their newer daily output;
+    manifest entries pointing at either are moved to the period file.
+    """
+    by_period: dict[str, list[Path]] = {}
+    for f in sorted(out_root.glob("all_min*.parquet")):
+        by_period.setdefault(period_of(extract_date(f), kind), []).append(f)
+    entries = manifest.parts()
+    for period, fs in sorted(by_period.items()):
+        dst = group_path(out_root, period)
+        days = [date.fromisoformat(extract_date(f)) for f in fs]
+        frames = [pl.scan_parquet(f) for f in fs]
+        if dst.exists():
+            old = pl.scan_parquet(dst).filter(~pl.col("trade_date").is_in(days))
+            frames.insert(0, old)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+        try:
+            pl.concat(frames, how="diagonal_relaxed").sort(
+                ["trade_date", "symbol", "K"]
+            ).sink_parquet(tmp)
+            os.replace(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+        repoint(manifest, entries, {str(dst), *(str(f) for f in fs)}, dst)
+        for f in fs:
+            f.unlink()
+        print(f"[compact] {period}: {len(fs)} daily files -> {dst}")
+
+
+def repoint(manifest: Manifest, entries: dict, paths: set[str], dst: Path):
+    """Point the manifest entries of ``paths`` at ``dst``, hashing it once.
+
+    If ``dst`` is gone the entries are forgotten, so their parts are rebuilt.
+    """
+    moved = [e for e in entries.values() if e["path"] in paths]
+    if not dst.exists():
+        for e in moved:
+            manifest.forget(e["part"])
+        return
+    sha = file_sha256(dst)
+    manifest.record_many([dict(e, path=str(dst), sha256=sha) for e in moved])
+
+
+def evict_days(
+    out_root: Path, days: list[str], manifest: Manifest, skip: set[Path] = frozenset()
+):
+    """Drop rebuilt days from the period files that also hold them.
+
+    A day recomputed after a --compact (or a --group run) lives in its new
+    all_min<date> file, or in the period files of this run (``skip``);
+    keeping the old rows too would make readers of <out>/**/*.parquet count
+    it twice until the next --compact.
+    """
+    entries = None
+    for dst in sorted(out_root.glob("year=*/rv_*.parquet")):
+        if dst in skip:
+            continue
+        period = dst.stem[len("rv_") :]
+        hit = [date.fromisoformat(d) for d in days if d.startswith(period)]
+        if not hit:
+            continue
+        keep = pl.scan_parquet(dst).filter(~pl.col("trade_date").is_in(hit))
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+        try:
+            keep.sink_parquet(tmp)
+            if pq.ParquetFile(tmp).metadata.num_rows:
+                os.replace(tmp, dst)
+            else:
+                dst.unlink()
+        finally:
+            tmp.unlink(missing_ok=True)
+        if entries is None:
+            entries = manifest.parts()
+        repoint(manifest, entries, {str(dst)}, dst)
+        print(f"[evict] {period}: {len(hit)} rebuilt days dropped from {dst}")
+
+
+def drop_daily(out_root: Path, days: list[str], manifest: Manifest):
+    """Remove the all_min<date> outputs (and their parts) of grouped days."""
+    n = 0
+    for d in days:
+        f = out_path(out_root, d)
+        if f.exists():
+            f.unlink()
+            n += 1
+        if manifest.get(d) is not None:
+            manifest.forget(d)
+    if n:
+        print(f"[drop] {n} all_min files now held by --group outputs")
+
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM, so a reused worker
+    # reports the peak of the current job only
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def profiled(fn, *args):
+    """Run one job in a worker; returns (fn's result, wall secs, peak RSS MB)."""
+    reset_peak_rss()
+    t0 = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - t0, peak_rss_mb()
+
+
+def run_jobs(jobs, workers: int, mem_budget: float, threads: int):
+    """Yield (job, result, wall, rss) as jobs finish.
+
+    ``jobs`` are (est_bytes, fn, args, ...). Largest first; a job is admitted
+    while the in-flight estimates fit ``mem_budget`` (a job bigger than the
+    budget runs alone). Each worker's Polars pool gets ``threads`` threads.
+    """
+    # read by Polars at import, so it must be in the workers' environment
+    os.environ["POLARS_MAX_THREADS"] = str(threads)
+    pending = sorted(jobs, key=lambda j: j[0], reverse=True)
+    inflight: dict = {}
+    ctx = mp.get_context("spawn")  # fresh interpreters pick up the env
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+        while pending or inflight:
+            while pending and len(inflight) < workers:
+                job = pending[0]
+                used = sum(j[0] for j in inflight.values())
+                if inflight and used + job[0] > mem_budget:
+                    break
+                pending.pop(0)
+                inflight[ex.submit(profiled, job[1], *job[2])] = job
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job = inflight.pop(fut)
+                yield (job, *fut.result())
+
+
+def total_ram() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
 
 
 def main():
@@ -60,12 +250,63 @@ def main():
         help="Parallel workers (2 is safe on small boxes)",
     )
     ap.add_argument(
-        "--overwrite", action="store_true", help="Overwrite existing outputs"
+        "--overwrite",
+        action="store_true",
+        help="Recompute everything, even outputs the manifest says are current",
+    )
+    ap.add_argument(
+        "--hash",
+        action="store_true",
+        help="Compare inputs by sha256 instead of size + mtime, so a re-fetched "
+        "but identical raw file is not recomputed (switching modes redoes all once)",
+    )
+    ap.add_argument(
+        "--verify",
+        action="store_true",
+        help="Also checksum outputs before skipping them",
+    )
+    ap.add_argument(
+        "--compact",
+        choices=["month", "year"],
+        default=None,
+        help="After the run, fold all_min<date> files into "
+        "<out>/year=YYYY/rv_<period>.parquet",
+    )
+    ap.add_argument(
+        "--group",
+        choices=["day", "month", "year"],
+        default=None,
+        help="Dataset mode: one job per day/month/year of files, written to "
+        "<out>/year=YYYY/rv_<period>.parquet (default: one all_min<date> per file)",
+    )
+    ap.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Total Polars threads, split across workers (default: all cores)",
     )
+    ap.add_argument(
+        "--mem-gb",
+        type=float,
+        default=None,
+        help="Memory budget for jobs in flight (default: 75%% of RAM)",
+    )
+    ap.add_argument(
+        "--mem-factor",
+        type=float,
+        default=10.0,
+        help="Estimated peak memory per job as a multiple of its input size",
+    )
+    ap.add_argument("--start", default=None, help="First file date (YYYY-MM-DD)")
+    ap.add_argument("--end", default=None, help="Last file date (YYYY-MM-DD)")
     args = ap.parse_args()
 
     inglob = os.path.expandvars(os.path.expanduser(args.inglob))
-    files = sorted(Path().glob(inglob) if "*" in inglob else [Path(inglob)])
+    all_files = sorted(Path().glob(inglob) if "*" in inglob else [Path(inglob)])
+    files = all_files
+    if args.start or args.end:
+        lo, hi = args.start or "0000-00-00", args.end or "9999-99-99"
+        files = [f for f in all_files if lo <= extract_date(f) <= hi]
     if not files:
         print(f"No files matched: {inglob}", file=sys.stderr)
         sys.exit(1)
@@ -80,20 +321,80 @@ def main():
     )
     out_root.mkdir(parents=True, exist_ok=True)
 
-    print(f"[cfg] n_files={len(files)} out_root={out_root} workers={args.workers}")
-    ok = err = skip = 0
-    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as ex:
-        futs = {ex.submit(do_one, f, out_root, args.overwrite): f for f in files}
-        for fut in as_completed(futs):
-            _, msg = fut.result()
-            print(msg)
-            if msg.startswith("OK"):
-                ok += 1
-            elif msg.startswith("SKIP"):
-                skip += 1
+    workers = max(1, args.workers)
+    threads = max(1, args.threads // workers)
+    mem_budget = (args.mem_gb * 1e9) if args.mem_gb else 0.75 * total_ram()
+    print(
+        f"[cfg] n_files={len(files)} out_root={out_root} workers={workers}"
+        f" group={args.group or 'file'} threads/worker={threads}"
+        f" mem_budget={mem_budget / 1e9:,.1f}GB"
+    )
+
+    def est(fs):
+        return args.mem_factor * sum(f.stat().st_size for f in fs)
+
+    # one unit per output: (manifest part, inputs, worker fn, worker args)
+    if args.group:
+        # --start/--end pick the periods; a period file is always rebuilt
+        # from all of its days, or the days outside the range would be lost
+        periods = {period_of(extract_date(f), args.group) for f in files}
+        groups: dict[str, list[Path]] = {}
+        for f in all_files:
+            k = period_of(extract_date(f), args.group)
+            if k in periods:
+                groups.setdefault(k, []).append(f)
+        units = [
+            (f"{args.group}:{k}", fs, do_group, (k, fs, out_root))
+            for k, fs in groups.items()
+        ]
+    else:
+        units = [(extract_date(f), [f], do_one, (f, out_root)) for f in files]
+
+    # incremental: skip outputs built from the same inputs by the same code
+    manifest = Manifest(out_root / "_manifest.sqlite")
+    params = fingerprint({"rv_version": RV_VERSION})
+    jobs = []
+    for part, fs, fn, fargs in units:
+        source = source_of(fs, args.hash)
+        if not args.overwrite:
+            why = manifest.check(part, params, source, verify=args.verify)
+            if why == "OK":
+                continue
+            if why != "NEW":
+                print(f"[{part}] redo ({why})")
+        jobs.append((est(fs), fn, fargs, part, source))
+    skip = len(units) - len(jobs)
+    print(f"[sync] {skip} of {len(units)} outputs up to date")
+
+    ok = err = 0
+    rebuilt = []
+    grouped: dict[Path, list[str]] = {}  # period file -> its days
+    t0 = time.perf_counter()
+    for job, (dst, msg, n), wall, rss in run_jobs(jobs, workers, mem_budget, threads):
+        if dst is not None:
+            ok += 1
+            msg += f" wall={wall:.1f}s rss={rss:,.0f}MB"
+            _, _, _, part, source = job
+            status = "OK" if n else "EMPTY"
+            manifest.record(part, dst, source, params, n, status=status)
+            if args.group:
+                grouped[dst] = [extract_date(f) for f in job[2][1]]
             else:
-                err += 1
-    print(f"[done] OK={ok} SKIP={skip} ERR={err}")
+                rebuilt.append(part)
+        else:
+            err += 1
+        print(msg)
+    print(f"[done] OK={ok} SKIP={skip} ERR={err} wall={time.perf_counter() - t0:.1f}s")
+
+    if grouped:
+        # the new period files hold these days now; drop every other copy
+        days = sorted({d for ds in grouped.values() for d in ds})
+        drop_daily(out_root, days, manifest)
+        evict_days(out_root, days, manifest, skip=set(grouped))
+    if args.compact:
+        compact_daily(out_root, args.compact, manifest)
+    elif rebuilt:
+        evict_days(out_root, rebuilt, manifest)
 
 
 if __name__ == "__main__":
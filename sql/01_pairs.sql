@@ -1,5 +1,3 @@
-PRAGMA threads=8;
-
 COPY (
 WITH raw AS (
   SELECT
@@ -11,7 +9,7 @@ WITH raw AS (
     iv, delta, vega, ask, bid,
     underlying_price                      AS S,
     dte
-  FROM read_parquet('${DATA_DIR}/raw/*.parquet')
+  FROM ${RAW_SRC}
   WHERE iv IS NOT NULL AND vega IS NOT NULL AND dte IS NOT NULL
     AND (${YEAR_FILTER})
 ),
@@ -59,5 +57,6 @@ FROM scored
 WHERE ivol_mid BETWEEN 0.01 AND 5.00
   AND ABS(x) < 1.0
   AND dte BETWEEN 1 AND 730
+ORDER BY c_date, stocks_id, expiration_date, K
 ) TO '${DATA_DIR}/curated/pairs${YEAR_SUFFIX}.parquet'
   (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 128000000);
@@ -1,5 +1,3 @@
-PRAGMA threads=8;
-
 COPY (
 WITH P AS (SELECT * FROM read_parquet('${DATA_DIR}/curated/pairs${YEAR_SUFFIX}.parquet')),
 ranked AS (
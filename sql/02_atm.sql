@@ -1,5 +1,3 @@
-PRAGMA threads=8;
-
 COPY (
 WITH P AS (SELECT * FROM read_parquet('${DATA_DIR}/curated/pairs${YEAR_SUFFIX}.parquet')),
 G AS (
@@ -35,5 +33,6 @@ SELECT
   S, tau, K_below, iv_below, K_above, iv_above,
   COALESCE(iv_atm, iv_interp, iv_below, iv_above) AS iv_atm
 FROM H
+ORDER BY c_date, stocks_id, expiration_date
 )  TO '${DATA_DIR}/curated/atm${YEAR_SUFFIX}.parquet'
   (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 128000000);
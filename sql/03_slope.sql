@@ -1,7 +1,6 @@
-PRAGMA threads=8;
 COPY (
-WITH P AS (SELECT * FROM read_parquet('$IVOL_DATA_DIR/curated/pairs${YEAR_SUFFIX}.parquet')),
-A AS (SELECT * FROM read_parquet('$IVOL_DATA_DIR/curated/atm${YEAR_SUFFIX}.parquet')),
+WITH P AS (SELECT * FROM read_parquet('${DATA_DIR}/curated/pairs${YEAR_SUFFIX}.parquet')),
+A AS (SELECT * FROM read_parquet('${DATA_DIR}/curated/atm${YEAR_SUFFIX}.parquet')),
 J AS (
   SELECT
     P.stocks_id, P.c_date, P.expiration_date, P.tau,
@@ -24,5 +23,6 @@ SELECT
   stocks_id, c_date, expiration_date,
   (sxy - sx*sy/sw) / NULLIF((sxx - (sx*sx)/sw),0) AS slope
 FROM agg
-) TO '$IVOL_DATA_DIR/curated/smile_slope${YEAR_SUFFIX}.parquet'
+ORDER BY c_date, stocks_id, expiration_date
+) TO '${DATA_DIR}/curated/smile_slope${YEAR_SUFFIX}.parquet'
 (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 128000000);
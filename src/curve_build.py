@@ -0,0 +1,566 @@
+# src/curve_build.py
+"""Curve builds (sql/01..04) in one DuckDB session, full or incremental.
+
+The stage files stay the source of truth (scripts/build_curves.sh still
+pipes them through envsubst). Here each stage's ``COPY (query) TO ...`` is
+split apart and the query becomes a temp table in one connection, so
+later stages read ``pairs`` / ``atm`` / ``smile_slope`` from memory
+instead of re-decoding the Parquet files. Only the requested outputs are
+written, with the stage's own COPY options, so they match build_curves.sh.
+
+Full builds (``--full [--year Y]``) write ``curated/<table>[_Y].parquet``.
+Incremental builds (the default) only rerun the c_dates whose raw rows
+changed since the last build, and write each table as
+``curated/<table>/c_date=YYYY-MM-DD/data_0.parquet``.
+
+The session runs with ``--threads`` / ``--mem-gb`` as DuckDB's threads and
+memory_limit, spilling to ``--temp-dir`` past it. Work is cut into runs of
+c_dates whose estimated working set (``--mem-factor`` x the raw bytes
+they read) fits CHUNK_SHARE of that limit, leaving DuckDB headroom, so a
+20-year build needs no manual year splitting.
+
+Incremental state lives in ``curated/_curves.sqlite``:
+- ``raw_dates``: one row per (raw file, c_date) with a row count and an
+  order-independent hash of the columns 01_pairs reads. Files are only
+  rescanned when their size/mtime change, and a store file rewritten by a
+  merge only invalidates the dates whose rows actually changed.
+- a Manifest entry per table and date, sourced from those signatures and
+  parametrized by the stage SQL text, so SQL edits rebuild everything.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from string import Template
+
+import duckdb
+import pyarrow.parquet as pq
+
+from manifest import Manifest, fingerprint
+from sqlite_util import transaction
+
+SQL_DIR = Path(__file__).resolve().parents[1] / "sql"
+
+# (curated table, stage file); each stage reads the previous outputs
+STAGES = [
+    ("pairs", "01_pairs.sql"),
+    ("atm", "02_atm.sql"),
+    ("smile_slope", "03_slope.sql"),
+    ("curve_headers", "04_curve_header.sql"),
+]
+
+# COPY (<query>) TO '<target>' (<options>); in a stage file
+COPY_RE = re.compile(
+    r"COPY\s*\((?P<query>.*)\)\s*TO\s*'(?P<target>[^']*)'\s*(?P<opts>\(.*?\))\s*;",
+    re.DOTALL,
+)
+# a stage reading an earlier stage's output file
+CURATED_RE = re.compile(
+    r"read_parquet\('\$\{DATA_DIR\}/curated/(\w+)\$\{YEAR_SUFFIX\}\.parquet'\)"
+)
+
+# DuckDB needs some memory of its own before it can spill at all
+MIN_MEM_GB = 0.25
+# chunks of c_dates are sized to this share of memory_limit; the rest is
+# headroom for DuckDB's buffers, the Parquet writer and a bad estimate
+CHUNK_SHARE = 0.5
+
+ROW_GROUP_RE = re.compile(r"ROW_GROUP_SIZE\s+\d+")
+CHUNKED_ROW_GROUP = 1_000_000
+
+DDL = """
+CREATE TABLE IF NOT EXISTS raw_dates(
+  path TEXT, size INT, mtime_ns INT, c_date TEXT, nrows INT, sig TEXT
+);
+CREATE INDEX IF NOT EXISTS raw_dates_path ON raw_dates(path);
+"""
+
+# per-date signature of a raw file: the inputs of 01_pairs' raw CTE
+SIG_SQL = """
+SELECT CAST(CAST(c_date AS DATE) AS VARCHAR) AS d, count(*) AS n,
+       CAST(sum(hash(stocks_id, CAST(expiration_date AS DATE), lower(call_put),
+                     price_strike, iv, delta, vega, ask, bid,
+                     underlying_price, dte)) AS VARCHAR) AS h
+FROM read_parquet(?)
+GROUP BY 1
+"""
+
+
+def raw_source(data_dir: Path) -> tuple[str, list[Path], bool]:
+    """(RAW_SRC expression, raw files, hive store?) as in build_curves.sh."""
+    store = data_dir / "store/ivol"
+    if store.is_dir():
+        src = (
+            f"read_parquet('{store}/*/*/*.parquet',"
+            " hive_partitioning=true, union_by_name=true)"
+        )
+        return src, sorted(store.glob("*/*/*.parquet")), True
+    raw = data_dir / "raw"
+    return f"read_parquet('{raw}/*.parquet')", sorted(raw.glob("*.parquet")), False
+
+
+def parse_stage(stage: str) -> tuple[list[str], str, str, str]:
+    """(leading statements, query, target, COPY options) of a stage file."""
+    text = (SQL_DIR / stage).read_text()
+    m = COPY_RE.search(text)
+    if m is None:
+        raise ValueError(f"{stage}: no COPY (...) TO '...' (...); statement")
+    pre = [st.strip() for st in text[: m.start()].split(";") if st.strip()]
+    return pre, m["query"], m["target"], m["opts"]
+
+
+def stage_deps() -> dict[str, set[str]]:
+    """{table: earlier tables its stage reads}."""
+    return {t: set(CURATED_RE.findall(parse_stage(f)[1])) for t, f in STAGES}
+
+
+def needed_tables(outputs) -> list[str]:
+    """Stages to run, in order, for the requested outputs."""
+    deps = stage_deps()
+    need = set(outputs)
+    for table, _ in reversed(STAGES):
+        if table in need:
+            need |= deps[table]
+    return [t for t, _ in STAGES if t in need]
+
+
+def run_stages(con, env: dict, outputs, keep=()):
+    """Run the stages on one connection.
+
+    ``outputs`` maps a table to the file to COPY it to (None: the stage's
+    own target); tables not in it only live as temp tables for later stages.
+    A stage's result is dropped once no later stage needs it, unless it is
+    in ``keep`` (left as a temp table for the caller).
+    """
+    deps = stage_deps()
+    keep = set(keep)
+    tables = needed_tables(set(outputs) | keep)
+    for i, table in enumerate(tables):
+        pre, query, target, opts = parse_stage(dict(STAGES)[table])
+        for st in pre:
+            con.execute(Template(st).safe_substitute(env))
+        query = Template(CURATED_RE.sub(r"\1", query)).safe_substitute(env)
+        later = any(table in deps[t] for t in tables[i + 1 :])
+        if later or table in keep:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE {table} AS {query}")
+            source = table
+        else:
+            source = f"({query})"
+        if table in outputs:
+            dst = outputs[table] or Template(target).safe_substitute(env)
+            con.execute(f"COPY {source} TO '{dst}' {opts}")
+        for dep in deps[table]:
+            if dep not in keep and not any(dep in deps[t] for t in tables[i + 1 :]):
+                con.execute(f"DROP TABLE IF EXISTS {dep}")
+
+
+def sql_version() -> str:
+    return fingerprint([(SQL_DIR / f).read_text() for _, f in STAGES])
+
+
+class RawIndex:
+    def __init__(self, db: Path):
+        self.db = Path(db)
+        self.db.parent.mkdir(parents=True, exist_ok=True)
+        with transaction(self.db) as conn:
+            conn.executescript(DDL)
+
+    def refresh(self, con, files: list[Path]) -> int:
+        """Rescan new/changed files, drop vanished ones; returns files scanned."""
+        with transaction(self.db) as conn:
+            rows = conn.execute("SELECT DISTINCT path, size, mtime_ns FROM raw_dates")
+            known = {p: (s, m) for p, s, m in rows}
+        current = {str(f): f.stat() for f in files}
+        scanned = 0
+        for path in known.keys() - current.keys():
+            with transaction(self.db) as conn:
+                conn.execute("DELETE FROM raw_dates WHERE path=?", (path,))
+        for path, st in current.items():
+            if known.get(path) == (st.st_size, st.st_mtime_ns):
+                continue
+            rows = con.execute(SIG_SQL, [path]).fetchall()
+            with transaction(self.db) as conn:
+                conn.execute("DELETE FROM raw_dates WHERE path=?", (path,))
+                conn.executemany(
+                    "INSERT INTO raw_dates VALUES (?,?,?,?,?,?)",
+                    [(path, st.st_size, st.st_mtime_ns, d, n, h) for d, n, h in rows],
+                )
+            scanned += 1
+        return scanned
+
+    def rows(self, start=None, end=None) -> list[tuple]:
+        """(c_date, path, size, nrows, sig) per raw file and date in range."""
+        sql = "SELECT c_date, path, size, nrows, sig FROM raw_dates WHERE 1=1"
+        params = []
+        if start:
+            sql += " AND c_date >= ?"
+            params.append(start)
+        if end:
+            sql += " AND c_date <= ?"
+            params.append(end)
+        with transaction(self.db) as conn:
+            return conn.execute(sql + " ORDER BY c_date, path", params).fetchall()
+
+    def sources(self, start=None, end=None) -> dict[str, str]:
+        """{c_date: fingerprint of every raw file's rows for that date}."""
+        by_date: dict[str, list] = {}
+        for d, path, _, n, sig in self.rows(start, end):
+            by_date.setdefault(d, []).append([path, n, sig])
+        return {d: fingerprint(v) for d, v in by_date.items()}
+
+    def day_bytes(self, start=None, end=None) -> dict[str, float]:
+        """{c_date: raw bytes read for it}, each file's size split by its rows."""
+        file_rows: dict[str, int] = {}
+        for _, path, _, n, _ in self.rows():
+            file_rows[path] = file_rows.get(path, 0) + n
+        out: dict[str, float] = {}
+        for d, path, size, n, _ in self.rows(start, end):
+            out[d] = out.get(d, 0) + size * n / max(file_rows[path], 1)
+        return out
+
+
+def footer_day_bytes(files: list[Path], start=None, end=None) -> dict[str, float]:
+    """{c_date: raw bytes} from Parquet footers, without reading any rows.
+
+    Each row group's compressed size is spread evenly over the calendar
+    days its c_date statistics span; a row group without statistics has
+    only its c_date column read.
+    """
+    out: dict[str, float] = {}
+    for f in files:
+        pf = pq.ParquetFile(f)
+        md = pf.metadata
+        for rg in range(md.num_row_groups):
+            g = md.row_group(rg)
+            cols = [g.column(i) for i in range(g.num_columns)]
+            c_date = [c for c in cols if c.path_in_schema == "c_date"]
+            if not c_date:
+                continue  # no c_date column: nothing 01_pairs would read
+            nbytes = sum(c.total_compressed_size for c in cols)
+            st = c_date[0].statistics
+            if st is not None and st.has_min_max:
+                lo = date.fromisoformat(str(st.min)[:10])
+                hi = date.fromisoformat(str(st.max)[:10])
+                n_days = (hi - lo).days + 1
+                share = {
+                    (lo + timedelta(days=i)).isoformat(): 1 / n_days
+                    for i in range(n_days)
+                }
+            else:
+                col = pf.read_row_group(rg, columns=["c_date"]).column(0)
+                days = [str(v)[:10] for v in col.to_pylist()]
+                share = {d: days.count(d) / len(days) for d in set(days)}
+            for d, frac in share.items():
+                out[d] = out.get(d, 0) + nbytes * frac
+    return {
+        d: b
+        for d, b in out.items()
+        if (start is None or d >= start) and (end is None or d <= end)
+    }
+
+
+def apply_settings(con, threads=None, mem_gb=None, temp_dir=None):
+    """DuckDB limits for a build; past ``mem_gb`` operators spill to ``temp_dir``."""
+    if threads:
+        con.execute(f"SET threads={int(threads)}")
+    if mem_gb:
+        con.execute(f"SET memory_limit='{mem_gb:.3f}GB'")
+    if temp_dir:
+        Path(temp_dir).mkdir(parents=True, exist_ok=True)
+        con.execute(f"SET temp_directory='{temp_dir}'")
+
+
+def chunk_days(day_bytes: dict, budget: float, mem_factor: float) -> list[list[str]]:
+    """Runs of consecutive c_dates whose estimated working set fits ``budget``.
+
+    The estimate is ``mem_factor`` x the raw bytes a date reads; a single
+    date over budget still gets a chunk of its own, and relies on DuckDB
+    spilling what does not fit its memory_limit. Callers pass a budget
+    below that limit (CHUNK_SHARE of it).
+    """
+    chunks, cur, used = [], [], 0.0
+    for d in sorted(day_bytes):
+        est = mem_factor * day_bytes[d]
+        if cur and used + est > budget:
+            chunks.append(cur)
+            cur, used = [], 0.0
+        cur.append(d)
+        used += est
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+def part_dir(curated: Path, table: str, day: str) -> Path:
+    return curated / table / f"c_date={day}"
+
+
+def build_dates(con, data_dir: Path, days: list[str], raw_src: str, hive: bool):
+    """Run the four stages for ``days``; returns {table: {day: nrows}}."""
+    curated = data_dir / "curated"
+    in_days = ", ".join(f"DATE '{d}'" for d in days)
+    year_filter = f"CAST(c_date AS DATE) IN ({in_days})"
+    if hive:
+        years = ", ".join(sorted({d[:4] for d in days}))
+        year_filter = f"year IN ({years}) AND {year_filter}"
+    env = {
+        "DATA_DIR": str(data_dir),
+        "RAW_SRC": raw_src,
+        "YEAR_FILTER": year_filter,
+        "YEAR_SUFFIX": "",
+    }
+    run_stages(con, env, {}, keep=[t for t, _ in STAGES])
+
+    counts = {}
+    for table, _ in STAGES:
+        for d in days:
+            shutil.rmtree(part_dir(curated, table, d), ignore_errors=True)
+        con.execute(
+            f"COPY {table} TO '{curated / table}'"
+            " (FORMAT PARQUET, COMPRESSION ZSTD, PARTITION_BY (c_date),"
+            " WRITE_PARTITION_COLUMNS true, OVERWRITE_OR_IGNORE)"
+        )
+        counts[table] = dict(
+            con.execute(
+                f"SELECT CAST(c_date AS VARCHAR), count(*) FROM {table} GROUP BY 1"
+            ).fetchall()
+        )
+        con.execute(f"DROP TABLE {table}")
+    return counts
+
+
+def build_full(con, data_dir: Path, year: str | None, outputs, chunks=None):
+    """What build_curves.sh [YEAR] writes, for the requested outputs only.
+
+    With more than one chunk of c_dates, each chunk runs the stages on its
+    own and writes to curated/_chunks; the chunk files are then streamed,
+    in date order, into the final outputs.
+    """
+    raw_src, _, hive = raw_source(data_dir)
+    if year:
+        year_filter = (
+            f"year = {year}" if hive else (f"year(CAST(c_date AS DATE)) = {year}")
+        )
+    else:
+        year_filter = "1=1"
+    env = {
+        "DATA_DIR": str(data_dir),
+        "RAW_SRC": raw_src,
+        "YEAR_FILTER": year_filter,
+        "YEAR_SUFFIX": f"_{year}" if year else "",
+    }
+    if not chunks or len(chunks) == 1:
+        run_stages(con, env, {t: None for t in outputs})
+        return
+
+    staging = data_dir / "curated" / "_chunks"
+    shutil.rmtree(staging, ignore_errors=True)
+    parts: dict[str, list[str]] = {t: [] for t in outputs}
+    try:
+        for i, days in enumerate(chunks):
+            t1 = time.perf_counter()
+            lo, hi = days[0], days[-1]
+            flt = f"CAST(c_date AS DATE) BETWEEN DATE '{lo}' AND DATE '{hi}'"
+            if hive and not year:
+                flt = f"year BETWEEN {lo[:4]} AND {hi[:4]} AND {flt}"
+            chunk_env = dict(env, YEAR_FILTER=f"({year_filter}) AND {flt}")
+            dsts = {}
+            for t in outputs:
+                (staging / t).mkdir(parents=True, exist_ok=True)
+                dsts[t] = str(staging / t / f"{i:04d}.parquet")
+                parts[t].append(dsts[t])
+            run_stages(con, chunk_env, dsts)
+            print(
+                f"[chunk] {i + 1}/{len(chunks)} {lo}..{hi}"
+                f" ({time.perf_counter() - t1:.1f}s)"
+            )
+        # chunks are date ranges in order, each sorted by c_date first; the
+        # stages' 128M-row groups would buffer a whole table, so cap them
+        for t in outputs:
+            _, _, target, opts = parse_stage(dict(STAGES)[t])
+            opts = ROW_GROUP_RE.sub(f"ROW_GROUP_SIZE {CHUNKED_ROW_GROUP}", opts)
+            files = ", ".join(f"'{f}'" for f in parts[t])
+            con.execute(
+                f"COPY (SELECT * FROM read_parquet([{files}]))"
+                f" TO '{Template(target).safe_substitute(env)}' {opts}"
+            )
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def total_ram() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def main():
+    from paths import resolve_data_dir
+
+    tables = [t for t, _ in STAGES]
+    p = argparse.ArgumentParser(
+        description="Build the curated curve tables in one DuckDB session "
+        "(default: incrementally, for changed c_dates only)."
+    )
+    p.add_argument("--data-dir", default=None, help="Default: $IVOL_DATA_DIR")
+    p.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild curated/<table>[_YEAR].parquet like build_curves.sh",
+    )
+    p.add_argument("--year", default=None, help="With --full: only this year")
+    p.add_argument(
+        "--outputs",
+        nargs="+",
+        choices=tables,
+        default=tables,
+        help="With --full: tables to write (others stay in memory)",
+    )
+    p.add_argument("--start", default=None, help="First c_date (YYYY-MM-DD)")
+    p.add_argument("--end", default=None, help="Last c_date (YYYY-MM-DD)")
+    p.add_argument("--rebuild", action="store_true", help="Rebuild every date in range")
+    p.add_argument(
+        "--dry-run", action="store_true", help="Only list the dates to rebuild"
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="DuckDB threads (default: all cores)",
+    )
+    p.add_argument(
+        "--mem-gb",
+        type=float,
+        default=None,
+        help=f"DuckDB memory_limit, at least {MIN_MEM_GB} (default: 75%% of "
+        f"RAM); chunks of c_dates are sized to {CHUNK_SHARE * 100:.0f}%% of it",
+    )
+    p.add_argument(
+        "--mem-factor",
+        type=float,
+        default=10.0,
+        help="Estimated working set as a multiple of the raw bytes read",
+    )
+    p.add_argument(
+        "--temp-dir",
+        default=None,
+        help="Where DuckDB spills past the memory limit "
+        "(default: $IVOL_DATA_DIR/tmp/duckdb)",
+    )
+    args = p.parse_args()
+
+    data_dir = resolve_data_dir(args.data_dir)
+    curated = data_dir / "curated"
+    curated.mkdir(parents=True, exist_ok=True)
+    raw_src, files, hive = raw_source(data_dir)
+
+    if args.mem_gb is not None and args.mem_gb < MIN_MEM_GB:
+        p.error(f"--mem-gb must be at least {MIN_MEM_GB}")
+    mem_gb = args.mem_gb or 0.75 * total_ram() / 1e9
+    budget = CHUNK_SHARE * mem_gb * 1e9
+    temp_dir = Path(args.temp_dir or data_dir / "tmp/duckdb")
+    t0 = time.perf_counter()
+    con = duckdb.connect()
+    apply_settings(con, args.threads, mem_gb, temp_dir)
+    if args.full:
+        start, end = (
+            (f"{args.year}-01-01", f"{args.year}-12-31") if args.year else (None, None)
+        )
+        # chunk sizes come from the Parquet footers; the per-date row
+        # signatures of the incremental index are not needed here
+        day_bytes = footer_day_bytes(files, start, end)
+        chunks = chunk_days(day_bytes, budget, args.mem_factor)
+        print(
+            f"[cfg] threads={args.threads} memory_limit={mem_gb:,.1f}GB"
+            f" temp_dir={temp_dir} chunks={len(chunks)}"
+        )
+        build_full(con, data_dir, args.year, args.outputs, chunks)
+        suffix = f"_{args.year}" if args.year else ""
+        for t in args.outputs:
+            print(f"[OK] {curated / f'{t}{suffix}.parquet'}")
+        print(f"[done] full build in {time.perf_counter() - t0:.1f}s")
+        return
+
+    index = RawIndex(curated / "_curves.sqlite")
+    scanned = index.refresh(con, files)
+
+    sources = index.sources(args.start, args.end)
+    print(
+        f"[cfg] raw files={len(files)} (rescanned {scanned}) dates={len(sources)}"
+        f" store={hive} curated={curated} threads={args.threads}"
+        f" memory_limit={mem_gb:,.1f}GB"
+    )
+
+    manifest = Manifest(curated / "_curves.sqlite")
+    params = sql_version()
+    todo = []
+    for d, source in sorted(sources.items()):
+        if args.rebuild:
+            todo.append(d)
+            continue
+        for table, _ in STAGES:
+            why = manifest.check(f"{table}/c_date={d}", params, source, verify=False)
+            if why != "OK":
+                if why != "NEW":
+                    print(f"[{d}] redo ({table}: {why})")
+                todo.append(d)
+                break
+
+    # dates whose raw rows are gone entirely
+    gone = set()
+    for part in manifest.parts():
+        d = part.split("c_date=", 1)[1]
+        if d not in sources and (args.start or d) <= d <= (args.end or d):
+            gone.add(d)
+
+    print(f"[sync] {len(sources) - len(todo)} of {len(sources)} dates up to date")
+    if args.dry_run:
+        for d in todo:
+            print(f"[todo] {d}")
+        for d in sorted(gone):
+            print(f"[drop] {d}")
+        return
+
+    for d in sorted(gone):
+        for table, _ in STAGES:
+            shutil.rmtree(part_dir(curated, table, d), ignore_errors=True)
+            manifest.forget(f"{table}/c_date={d}")
+        print(f"[drop] {d}: no raw rows left")
+
+    # batches within a year (a bounded IN list, and year pruning on the
+    # store) whose estimated working set fits the memory budget
+    day_bytes = index.day_bytes(args.start, args.end)
+    by_year: dict[str, list[str]] = {}
+    for d in todo:
+        by_year.setdefault(d[:4], []).append(d)
+    batches = []
+    for year, days in sorted(by_year.items()):
+        sizes = {d: day_bytes.get(d, 0) for d in days}
+        batches += [(year, c) for c in chunk_days(sizes, budget, args.mem_factor)]
+    for year, days in batches:
+        t1 = time.perf_counter()
+        counts = build_dates(con, data_dir, days, raw_src, hive)
+        for d in days:
+            for table, _ in STAGES:
+                n = counts[table].get(d, 0)
+                files_ = sorted(part_dir(curated, table, d).glob("*.parquet"))
+                manifest.record(
+                    f"{table}/c_date={d}",
+                    files_[0] if n else None,
+                    sources[d],
+                    params,
+                    n,
+                    status="OK" if n else "EMPTY",
+                )
+        n_pairs = sum(counts["pairs"].values())
+        print(
+            f"[OK] {year} ({days[0]}..{days[-1]}): {len(days)} dates, {n_pairs:,} pairs"
+            f" ({time.perf_counter() - t1:.1f}s)"
+        )
+    print(f"[done] {len(todo)} dates rebuilt in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
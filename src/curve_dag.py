@@ -0,0 +1,359 @@
+# src/curve_dag.py
+"""Curve history builds as a DAG of (partition, stage) nodes.
+
+Each year or month is a partition, and its four stages (sql/01..04) are
+nodes: ``pairs -> atm -> smile_slope -> curve_headers`` with the edges
+read off the stage SQL (03 needs pairs and atm, 04 atm and smile_slope).
+A node runs its stage file like build_curves.sh does, in a worker
+process, and writes ``curated/<table>_<partition>.parquet``.
+
+Nodes of different partitions are independent, so they run concurrently:
+``--threads`` DuckDB threads are split across ``--workers`` processes, and
+a ready node is only started while the estimated memory of the nodes in
+flight fits ``--mem-gb`` (largest first; one node bigger than the budget
+runs alone).
+
+Every finished node is recorded in ``curated/_dag.sqlite``: its source
+is the raw rows of the partition (pairs) or the checksums of its inputs
+(later stages), its params the stage's SQL text. A rerun after a failure
+or an edit skips every node that is still current and resumes from the
+first one that is not. ``--start``/``--end`` only choose the partitions
+to consider; each is still built, and fingerprinted, whole.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from string import Template
+
+import duckdb
+
+from curve_build import (
+    MIN_MEM_GB,
+    SQL_DIR,
+    STAGES,
+    RawIndex,
+    apply_settings,
+    parse_stage,
+    raw_source,
+    stage_deps,
+    total_ram,
+)
+from manifest import Manifest, fingerprint
+
+
+def partition_of(day: str, by: str) -> str:
+    return day[:4] if by == "year" else day[:7]
+
+
+def partition_filter(part: str, hive: bool) -> str:
+    """YEAR_FILTER of a ``YYYY`` or ``YYYY-MM`` partition, as build_curves.sh."""
+    year = part[:4]
+    # the store is hive-partitioned by year: filter on it so other years'
+    # files are never opened
+    flt = f"year = {year}" if hive else f"year(CAST(c_date AS DATE)) = {year}"
+    if len(part) > 4:
+        flt += f" AND month(CAST(c_date AS DATE)) = {int(part[5:7])}"
+    return flt
+
+
+def node_name(table: str, part: str) -> str:
+    return f"{table}_{part}"
+
+
+def run_node(table: str, env: dict, threads: int, mem_gb: float, temp_dir: Path):
+    """Worker: run one stage for one partition; returns (rows, wall secs)."""
+    t0 = time.perf_counter()
+    pre, query, target, opts = parse_stage(dict(STAGES)[table])
+    dst = Path(Template(target).safe_substitute(env))
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    # spill files of concurrent workers must not collide
+    spill = temp_dir / f"worker{os.getpid()}"
+    con = duckdb.connect()
+    try:
+        for st in pre:
+            con.execute(Template(st).safe_substitute(env))
+        apply_settings(con, threads, mem_gb, spill)
+        query = Template(query).safe_substitute(env)
+        (n,) = con.execute(f"COPY ({query}) TO '{tmp}' {opts}").fetchone()
+        con.close()
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+        shutil.rmtree(spill, ignore_errors=True)
+    return n, time.perf_counter() - t0
+
+
+class CurveDag:
+    def __init__(self, data_dir: Path, by: str, start=None, end=None):
+        self.data_dir = data_dir
+        self.curated = data_dir / "curated"
+        self.raw_src, files, self.hive = raw_source(data_dir)
+        self.deps = stage_deps()
+        self.params = {t: fingerprint((SQL_DIR / f).read_text()) for t, f in STAGES}
+        self.manifest = Manifest(self.curated / "_dag.sqlite")
+
+        index = RawIndex(self.curated / "_curves.sqlite")
+        self.scanned = index.refresh(duckdb.connect(), files)
+        # --start/--end only pick partitions: a node always builds its whole
+        # year/month, so it is fingerprinted and sized over all of it
+        picked = {partition_of(d, by) for d in index.sources(start, end)}
+        rows: dict[str, list] = {}
+        for d, path, _, n, sig in index.rows():
+            if partition_of(d, by) in picked:
+                rows.setdefault(partition_of(d, by), []).append([d, path, n, sig])
+        self.raw_bytes: dict[str, float] = {}
+        for d, nbytes in index.day_bytes().items():
+            part = partition_of(d, by)
+            if part in picked:
+                self.raw_bytes[part] = self.raw_bytes.get(part, 0) + nbytes
+        self.sources = {p: fingerprint(v) for p, v in rows.items()}
+        self.partitions = sorted(self.sources)
+
+    def env(self, part: str) -> dict:
+        return {
+            "DATA_DIR": str(self.data_dir),
+            "RAW_SRC": self.raw_src,
+            "YEAR_FILTER": partition_filter(part, self.hive),
+            "YEAR_SUFFIX": f"_{part}",
+        }
+
+    def output(self, table: str, part: str) -> Path:
+        return self.curated / f"{node_name(table, part)}.parquet"
+
+    def source(self, table: str, part: str) -> str:
+        """What a node is built from: raw rows, or its inputs' checksums."""
+        if not self.deps[table]:
+            return self.sources[part]
+        sig = []
+        for dep in sorted(self.deps[table]):
+            e = self.manifest.get(node_name(dep, part)) or {}
+            sig.append([dep, e.get("sha256"), e.get("nrows")])
+        return fingerprint(sig)
+
+    def plan(self, rebuild: bool = False) -> dict[tuple[str, str], str]:
+        """{(table, partition): why} of the nodes to run, upstream first."""
+        todo = {}
+        for part in self.partitions:
+            for table, _ in STAGES:
+                if rebuild:
+                    todo[table, part] = "REBUILD"
+                elif any((dep, part) in todo for dep in self.deps[table]):
+                    todo[table, part] = "UPSTREAM"
+                else:
+                    why = self.manifest.check(
+                        node_name(table, part),
+                        self.params[table],
+                        self.source(table, part),
+                        verify=False,
+                    )
+                    if why != "OK":
+                        todo[table, part] = why
+        return todo
+
+    def estimate(self, table: str, part: str, mem_factor: float) -> float:
+        """Working-set guess: a multiple of the bytes the node reads."""
+        if not self.deps[table]:
+            return mem_factor * self.raw_bytes.get(part, 0)
+        paths = [self.output(dep, part) for dep in self.deps[table]]
+        return mem_factor * sum(p.stat().st_size for p in paths if p.exists())
+
+    def run(
+        self,
+        todo,
+        workers: int,
+        threads: int,
+        mem_budget: float,
+        mem_factor: float,
+        temp_dir: Path,
+    ):
+        """Run ``todo`` in dependency order; yields (node, rows, wall, error).
+
+        Each worker's DuckDB gets ``threads`` threads and an equal share of
+        ``mem_budget`` as its memory_limit, spilling to ``temp_dir`` past it.
+        """
+        mem_gb = mem_budget / workers / 1e9
+        waiting = dict(todo)
+        inflight: dict = {}
+        failed: set = set()
+        ctx = mp.get_context("spawn")  # don't fork a process holding DuckDB
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+            while waiting or inflight:
+                running = {node for node, _ in inflight.values()}
+                ready = [
+                    node
+                    for node in waiting
+                    if not any(
+                        (dep, node[1]) in waiting or (dep, node[1]) in running
+                        for dep in self.deps[node[0]]
+                    )
+                ]
+                for node in ready:
+                    if any((dep, node[1]) in failed for dep in self.deps[node[0]]):
+                        del waiting[node]
+                        failed.add(node)
+                        yield node, 0, 0.0, "BLOCKED"
+                ready = sorted(
+                    (
+                        (self.estimate(*node, mem_factor), node)
+                        for node in ready
+                        if node in waiting
+                    ),
+                    reverse=True,
+                )
+                for est, node in ready:
+                    if len(inflight) >= workers:
+                        break
+                    used = sum(e for _, e in inflight.values())
+                    if inflight and used + est > mem_budget:
+                        continue
+                    del waiting[node]
+                    fut = ex.submit(
+                        run_node,
+                        node[0],
+                        self.env(node[1]),
+                        threads,
+                        mem_gb,
+                        temp_dir,
+                    )
+                    inflight[fut] = (node, est)
+                if not inflight:
+                    continue
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    node, _ = inflight.pop(fut)
+                    try:
+                        n, wall = fut.result()
+                    except Exception as e:
+                        failed.add(node)
+                        yield node, 0, 0.0, f"{e}\n{traceback.format_exc()}"
+                        continue
+                    table, part = node
+                    self.manifest.record(
+                        node_name(table, part),
+                        self.output(table, part),
+                        self.source(table, part),
+                        self.params[table],
+                        n,
+                        status="OK" if n else "EMPTY",
+                    )
+                    yield node, n, wall, None
+
+
+def main():
+    from paths import resolve_data_dir
+
+    p = argparse.ArgumentParser(
+        description="Build curated/<table>_<year|month>.parquet for every "
+        "partition, running independent partitions in parallel."
+    )
+    p.add_argument("--data-dir", default=None, help="Default: $IVOL_DATA_DIR")
+    p.add_argument(
+        "--by", choices=["year", "month"], default="year", help="Partition size"
+    )
+    p.add_argument(
+        "--start",
+        default=None,
+        help="Only partitions with c_dates from here on (built whole)",
+    )
+    p.add_argument(
+        "--end",
+        default=None,
+        help="Only partitions with c_dates up to here (built whole)",
+    )
+    p.add_argument("--workers", type=int, default=2, help="Nodes run at the same time")
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Total DuckDB threads, split across workers (default: all cores)",
+    )
+    p.add_argument(
+        "--mem-gb",
+        type=float,
+        default=None,
+        help="Memory budget for nodes in flight, split into the workers' "
+        f"memory_limit (at least {MIN_MEM_GB} each; default: 75%% of RAM)",
+    )
+    p.add_argument(
+        "--mem-factor",
+        type=float,
+        default=10.0,
+        help="Estimated peak memory per node as a multiple of the Parquet "
+        "bytes it reads",
+    )
+    p.add_argument(
+        "--temp-dir",
+        default=None,
+        help="Where DuckDB spills past each worker's memory limit "
+        "(default: $IVOL_DATA_DIR/tmp/duckdb)",
+    )
+    p.add_argument("--rebuild", action="store_true", help="Rerun every node")
+    p.add_argument("--dry-run", action="store_true", help="Only list the nodes to run")
+    args = p.parse_args()
+
+    data_dir = resolve_data_dir(args.data_dir)
+    (data_dir / "curated").mkdir(parents=True, exist_ok=True)
+    dag = CurveDag(data_dir, args.by, args.start, args.end)
+    workers = max(1, args.workers)
+    threads = max(1, args.threads // workers)
+    mem_budget = (args.mem_gb * 1e9) if args.mem_gb else 0.75 * total_ram()
+    if mem_budget / workers < MIN_MEM_GB * 1e9:
+        p.error(f"--mem-gb must give each worker at least {MIN_MEM_GB} GB")
+    temp_dir = Path(args.temp_dir or data_dir / "tmp/duckdb")
+    print(
+        f"[cfg] partitions={len(dag.partitions)} by={args.by} (raw rescanned"
+        f" {dag.scanned}) workers={workers} threads/worker={threads}"
+        f" mem_budget={mem_budget / 1e9:,.1f}GB"
+    )
+
+    todo = dag.plan(args.rebuild)
+    n_nodes = len(dag.partitions) * len(STAGES)
+    for (table, part), why in todo.items():
+        if why not in ("NEW", "UPSTREAM", "REBUILD"):
+            print(f"[{node_name(table, part)}] redo ({why})")
+    print(f"[sync] {n_nodes - len(todo)} of {n_nodes} nodes up to date")
+    if args.dry_run:
+        for table, part in todo:
+            print(f"[todo] {node_name(table, part)}")
+        return
+
+    t0 = time.perf_counter()
+    ok = err = blocked = 0
+    per_stage: dict[str, list[float]] = {t: [] for t, _ in STAGES}
+    for (table, part), n, wall, error in dag.run(
+        todo, workers, threads, mem_budget, args.mem_factor, temp_dir
+    ):
+        name = node_name(table, part)
+        if error is None:
+            ok += 1
+            per_stage[table].append(wall)
+            print(f"[OK] {name}: {n:,} rows wall={wall:.1f}s")
+        elif error == "BLOCKED":
+            blocked += 1
+            print(f"[SKIP] {name}: an upstream node failed")
+        else:
+            err += 1
+            print(f"[ERR] {name}: {error}")
+    for table, walls in per_stage.items():
+        if walls:
+            print(
+                f"[time] {table:<14} nodes={len(walls):<4} total={sum(walls):.1f}s"
+                f" max={max(walls):.1f}s"
+            )
+    print(
+        f"[done] OK={ok} SKIP={n_nodes - len(todo)} ERR={err} BLOCKED={blocked}"
+        f" wall={time.perf_counter() - t0:.1f}s"
+    )
+    if err or blocked:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,21 @@
 # fetch_ivol_by_list.py
 import os
 import time
+import random
 import argparse
+import shutil
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 import ivolatility as ivol
-from paths import RAW_DIR
+from paths import DATA_DIR, RAW_DIR, TMP_DIR
+from ivol_cache import ResponseCache, date_gaps
+from ivol_store import RawStore, compact_table
+import ledger
 
 # -------------------------- Helpers --------------------------
 
@@ -59,6 +70,97 @@ def parse_args():
     p.add_argument(
         "--key", default=None, help="IVOL API key (or set IVOL_API_KEY env var)."
     )
+    p.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Parallel API calls (max in flight). 1 = serial loop with --sleep.",
+    )
+    p.add_argument(
+        "--rps",
+        type=float,
+        default=None,
+        help="Global requests/second budget shared by all workers"
+        " (default: 1/--sleep).",
+    )
+    p.add_argument(
+        "--burst",
+        type=int,
+        default=1,
+        help="Token-bucket capacity: calls allowed back-to-back before --rps applies.",
+    )
+    p.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Retries per call with exponential backoff (throttling / 5xx / network).",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip (symbol, cp, chunk) units the ledger has as done for this"
+        " output; fetch only missing/failed ones and append to the existing file.",
+    )
+    p.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Size each date window from the symbol's observed rows/day"
+        " (ledger history, then this run) instead of a fixed --chunk-days.",
+    )
+    p.add_argument(
+        "--target-rows",
+        type=int,
+        default=20_000,
+        help="Adaptive: aim for about this many rows per API call.",
+    )
+    p.add_argument(
+        "--max-chunk-days",
+        type=int,
+        default=366,
+        help="Adaptive: upper bound on a window for sparse names.",
+    )
+    p.add_argument(
+        "--row-limit",
+        type=int,
+        default=None,
+        help="Provider row cap: a response this large is treated as truncated"
+        " and its window is split in half and refetched. Without it a window"
+        " is still split when its rows stop more than a week before its end.",
+    )
+    p.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep raw responses locally; requests inside a cached DTE/delta"
+        " band are filtered locally and only uncovered dates hit the API.",
+    )
+    p.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Response cache dir (default: ${IVOL_DATA_DIR}/cache/ivol).",
+    )
+    p.add_argument(
+        "--store",
+        action="store_true",
+        help="Also merge each symbol into the primary-key deduplicated raw"
+        " store (year=/symbol= partitions) read by the curve builds.",
+    )
+    p.add_argument(
+        "--layout",
+        choices=["flat", "hive"],
+        default="flat",
+        help="flat: ivol_<SYM>_<tag> files in --outdir; hive: write only to the"
+        " raw store (year=YYYY/symbol=SYM), per-symbol files are just staging.",
+    )
+    p.add_argument(
+        "--store-dir",
+        default=None,
+        help="Raw store root (default: ${IVOL_DATA_DIR}/store/ivol).",
+    )
+    p.add_argument(
+        "--base-url",
+        default=None,
+        help="Override the REST base URL (e.g. a local fake for tests).",
+    )
     return p.parse_args()
 
 
@@ -86,11 +188,259 @@ def daterange_chunks(start, end, chunk_days):
         cur = chunk_end + pd.Timedelta(days=1)
 
 
+class ChunkPlanner:
+    """Adaptive date windows per (symbol, cp) from observed rows per day.
+
+    Each window is sized to about ``target_rows`` rows at the latest density
+    estimate, between 1 and ``max_days`` days; with no observations yet the
+    fixed ``default_days`` is used. Windows are generated lazily, so later
+    ones use what earlier responses taught.
+    """
+
+    def __init__(self, target_rows, default_days, max_days):
+        self.target_rows = target_rows
+        self.default_days = default_days
+        self.max_days = max_days
+        self._seen = {}  # (sym, cp) -> [rows, calendar days]
+        self._lock = threading.Lock()
+
+    def seed(self, sym, cp, rows, days):
+        """Start from history (e.g. ledger.density) before this run's data."""
+        with self._lock:
+            if (sym, cp) not in self._seen and days:
+                self._seen[(sym, cp)] = [rows, days]
+
+    def observe(self, sym, cp, cs, ce, nrows):
+        days = (pd.Timestamp(ce) - pd.Timestamp(cs)).days + 1
+        with self._lock:
+            seen = self._seen.setdefault((sym, cp), [0, 0])
+            seen[0] += nrows
+            seen[1] += days
+
+    def days_for(self, sym, cp):
+        with self._lock:
+            rows, days = self._seen.get((sym, cp), (0, 0))
+        if days == 0:
+            return self.default_days
+        if rows == 0:
+            return self.max_days
+        return int(min(self.max_days, max(1, self.target_rows * days // rows)))
+
+    def windows(self, sym, cp, start, end):
+        cur, end_dt = pd.Timestamp(start), pd.Timestamp(end)
+        while cur <= end_dt:
+            step = pd.Timedelta(days=self.days_for(sym, cp) - 1)
+            chunk_end = min(cur + step, end_dt)
+            yield cur.date().isoformat(), chunk_end.date().isoformat()
+            cur = chunk_end + pd.Timedelta(days=1)
+
+
 def delta_band(cp, lo, hi):
     """Calls: +lo..+hi; Puts: -hi..-lo."""
     return (lo, hi) if cp == "C" else (-hi, -lo)
 
 
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` tokens/s, up to ``capacity`` banked.
+
+    ``acquire()`` blocks until a token is available. ``cooldown(secs)`` stops
+    every worker for a while, used when the provider says we are throttled.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._blocked_until:
+                    self._tokens = min(
+                        self.capacity, self._tokens + (now - self._last) * self.rate
+                    )
+                    self._last = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait_s = (1.0 - self._tokens) / self.rate
+                else:
+                    wait_s = self._blocked_until - now
+            time.sleep(wait_s)
+
+    def cooldown(self, secs: float):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + secs)
+            self._tokens = 0.0
+            self._last = max(self._last, self._blocked_until)
+
+
+def is_throttled(e: Exception) -> bool:
+    resp = getattr(e, "response", None)
+    code = getattr(resp, "status_code", None)
+    if code is not None:
+        return code == 429
+    msg = str(e).lower()
+    return "429" in msg or "too many requests" in msg or "rate limit" in msg
+
+
+def is_retryable(e: Exception) -> bool:
+    resp = getattr(e, "response", None)
+    code = getattr(resp, "status_code", None)
+    if code is not None:
+        return code == 429 or code >= 500
+    # the SDK's own retries give up with RetryError ("too many 429 ...")
+    return isinstance(
+        e, (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)
+    )
+
+
+def call_api(get_opts, sym, cp, cs, ce, dte, band, limiter=None, retries=5):
+    """One API call with retry + backoff; ``band`` is the signed delta band.
+
+    Returns a DataFrame (possibly empty); raises after ``retries`` failures.
+    """
+    dte_lo, dte_hi = dte
+    dlo, dhi = band
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            df = get_opts(
+                symbol=sym,
+                cp=cp,
+                startDate=cs,
+                endDate=ce,
+                dteFrom=dte_lo,
+                dteTo=dte_hi,
+                deltaFrom=dlo,
+                deltaTo=dhi,
+            )
+            return df if df is not None else pd.DataFrame()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            backoff = min(60.0, 2.0**attempt) * (0.5 + random.random())
+            if is_throttled(e) and limiter is not None:
+                # throttling is global: pause everyone, not just this worker
+                limiter.cooldown(backoff)
+            else:
+                time.sleep(backoff)
+
+
+def is_too_big(e: Exception) -> bool:
+    """Failures that a smaller date window may avoid (timeouts, 413/504)."""
+    code = getattr(getattr(e, "response", None), "status_code", None)
+    if code is not None:
+        return code in (413, 504)
+    return isinstance(e, requests.Timeout) or "504" in str(e)
+
+
+# a response whose last c_date is this far before the window end (or today)
+# was most likely cut off by the provider
+TRUNC_GAP_DAYS = 7
+
+# provider cap learned this run: the size of a response that stopped short
+# although the rest of its window did have rows
+_learned_cap: int | None = None
+
+
+def truncation(df, ce, row_limit=None) -> str | None:
+    """Why ``df`` looks truncated for a window ending ``ce``, else None.
+
+    Either it hit ``row_limit`` (or the cap learned this run), or its rows
+    stop more than TRUNC_GAP_DAYS before the window end, which is what a
+    silent provider cap looks like (rows come back in date order).
+    """
+    if df is None or len(df) == 0:
+        return None
+    if row_limit and len(df) >= row_limit:
+        return f"{len(df):,} rows, at --row-limit"
+    if _learned_cap and len(df) >= _learned_cap:
+        return f"{len(df):,} rows, at the provider cap"
+    if "c_date" not in df.columns:
+        return None
+    last = pd.to_datetime(df["c_date"], errors="coerce").max()
+    end = min(pd.Timestamp(ce), pd.Timestamp.today().normalize())
+    if pd.notna(last) and (end - last).days > TRUNC_GAP_DAYS:
+        return f"{len(df):,} rows ending {last.date()}"
+    return None
+
+
+def learn_cap(rows: int):
+    global _learned_cap
+    if _learned_cap is None or rows < _learned_cap:
+        _learned_cap = rows
+        print(f"[cap] responses look capped at {rows:,} rows; splitting at that size")
+
+
+def fetch_window(
+    get_opts, sym, cp, cs, ce, dte, band, limiter, retries, cache, row_limit
+):
+    """call_api for [cs, ce], halving the window while it comes back truncated
+    (see ``truncation``) or fails as too big; whole responses are cached."""
+    try:
+        df = call_api(get_opts, sym, cp, cs, ce, dte, band, limiter, retries)
+    except Exception as e:
+        if cs == ce or not is_too_big(e):
+            raise
+        df, why = None, f"too big: {e}"
+    else:
+        why = truncation(df, ce, row_limit)
+    if df is not None and not (why and cs < ce):
+        if why:
+            print(f"[WARN] {sym} {cp} {cs}: {why}, can't split further")
+        elif cache is not None:
+            cache.put(sym, cp, cs, ce, dte, band, df)
+        return df
+    mid = pd.Timestamp(cs) + (pd.Timestamp(ce) - pd.Timestamp(cs)) / 2
+    left_end = mid.date().isoformat()
+    right_start = (mid + pd.Timedelta(days=1)).date().isoformat()
+    print(f"[SPLIT] {sym} {cp} {cs}->{ce} ({why})")
+    args = (dte, band, limiter, retries, cache, row_limit)
+    # right half first: rows there prove ``df`` was cut off, so the cap is
+    # known before the left half (which may be just over it) comes back
+    right = fetch_window(get_opts, sym, cp, right_start, ce, *args)
+    if df is not None and not row_limit and len(right) > 0:
+        learn_cap(len(df))
+    parts = [fetch_window(get_opts, sym, cp, cs, left_end, *args), right]
+    return pd.concat([p for p in parts if len(p) > 0] or [pd.DataFrame()])
+
+
+def fetch_unit(
+    get_opts,
+    sym,
+    cp,
+    cs,
+    ce,
+    dte,
+    delta,
+    limiter=None,
+    retries=5,
+    cache=None,
+    row_limit=None,
+):
+    """Rows for one (symbol, call/put, date chunk) unit.
+
+    With a ResponseCache, dates covered by a cached superset band are
+    filtered locally and only the remaining gaps are fetched (and cached).
+    """
+    band = delta_band(cp, *delta)
+    args = (dte, band, limiter, retries, cache, row_limit)
+    if cache is None:
+        return fetch_window(get_opts, sym, cp, cs, ce, *args)
+    cached, gaps = cache.lookup(sym, cp, cs, ce, dte, band)
+    frames = [cached] if cached is not None else []
+    for gs, ge in gaps:
+        frames.append(fetch_window(get_opts, sym, cp, gs, ge, *args))
+    frames = [f for f in frames if len(f) > 0]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
 def dedup(df):
     # Use the most stable keys present
     keys_pref = [
@@ -107,24 +457,272 @@ def dedup(df):
     return df
 
 
-def write_frame(df, path, fmt):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if fmt == "parquet":
+def in_band(df, abs_lo, abs_hi):
+    """Keep only rows truly in-band: calls +lo..+hi, puts -hi..-lo."""
+    if "delta" not in df.columns or "call_put" not in df.columns:
+        return df
+    cpcol = df["call_put"].astype(str)
+    mask = (
+        (cpcol == "C") & (df["delta"].between(abs_lo, abs_hi, inclusive="both"))
+    ) | ((cpcol == "P") & (df["delta"].between(-abs_hi, -abs_lo, inclusive="both")))
+    return df[mask]
+
+
+def no_null_types(schema: pa.Schema) -> pa.Schema:
+    """``schema`` without metadata; all-null (type null) columns become strings."""
+    return pa.schema(
+        [f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in schema]
+    ).remove_metadata()
+
+
+def conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """``table`` cast to ``schema``, with its missing columns filled with nulls."""
+    for f in schema:
+        if f.name not in table.column_names:
+            table = table.append_column(f.name, pa.nulls(len(table), f.type))
+    return table.select(schema.names).cast(schema)
+
+
+class ChunkWriter:
+    """Append chunk frames to one output file as they arrive.
+
+    Parquet: one sorted row group per chunk, in the compact schema of
+    ivol_store.compact_table, via ParquetWriter. Chunks are cast to the
+    file's schema; a chunk with new columns or wider types widens it (the
+    rows written so far are rewritten once), and one whose types can't be
+    reconciled raises ValueError. CSV: appended with a single header.
+    Written to ``<path>.tmp`` and renamed on close(). With ``append=True``
+    an existing output is copied in first (resumed pulls).
+    """
+
+    def __init__(self, path, fmt, schema=None, append=False):
+        self.path = path
+        self.fmt = fmt
+        self.tmp = path + ".tmp"
+        self.rows = 0
+        self._writer = None
+        self._started = False
+        self.schema = schema
+        self.append = append and os.path.exists(path)
+        self._seen = set()  # columns with a non-null value written
+
+    def _start(self):
+        self._started = True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)  # left over from an interrupted run
+        if not self.append:
+            return
+        if self.fmt == "csv":
+            shutil.copyfile(self.path, self.tmp)
+            with open(self.path, "rb") as fh:
+                self.rows = max(0, sum(1 for _ in fh) - 1)
+        else:
+            pf = pq.ParquetFile(self.path)
+            self.schema = pf.schema_arrow.remove_metadata()
+            self._seen = set(self.schema.names)
+            self._writer = pq.ParquetWriter(self.tmp, self.schema)
+            for i in range(pf.num_row_groups):
+                self._writer.write_table(pf.read_row_group(i).cast(self.schema))
+            self.rows = pf.metadata.num_rows
+
+    def add(self, df):
+        if df is None or len(df) == 0:
+            return
+        if not self._started:
+            self._start()
+        if self.fmt == "csv":
+            header = not os.path.exists(self.tmp)
+            df.to_csv(self.tmp, mode="a", header=header, index=False)
+        else:
+            # typed dates/ids/greeks, rows sorted within the chunk's row group
+            table = compact_table(pa.Table.from_pandas(df, preserve_index=False))
+            if self._writer is None:
+                self.schema = no_null_types(self.schema or table.schema)
+                self._writer = pq.ParquetWriter(self.tmp, self.schema)
+            else:
+                # columns that were all-null so far take their first real type
+                base = pa.schema(
+                    [
+                        (
+                            table.schema.field(f.name)
+                            if f.name not in self._seen
+                            and f.name in table.column_names
+                            and table[f.name].null_count < len(table)
+                            else f
+                        )
+                        for f in self.schema
+                    ]
+                ).remove_metadata()
+                try:
+                    wider = pa.unify_schemas(
+                        [base, table.schema.remove_metadata()],
+                        promote_options="permissive",
+                    )
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # conflicting types are left to the cast below
+                    wider = pa.schema(
+                        list(base)
+                        + [f for f in table.schema if f.name not in base.names]
+                    )
+                wider = no_null_types(wider)
+                if not wider.equals(self.schema):
+                    self._widen(wider)
+            try:
+                table = conform(table, self.schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError(
+                    f"{os.path.basename(self.path)}: chunk does not fit the"
+                    f" output schema: {e}"
+                ) from e
+            self._writer.write_table(table)
+            self._seen |= {
+                n for n in table.column_names if table[n].null_count < len(table)
+            }
+        self.rows += len(df)
+
+    def _widen(self, schema):
+        """Reopen the .tmp under a wider ``schema``, copying the rows so far."""
+        self._writer.close()
+        old = self.tmp + ".old"
+        os.replace(self.tmp, old)
         try:
-            df.to_parquet(path, index=False)
-        except Exception:
-            # fall back if pyarrow/fastparquet not present
-            csv_path = os.path.splitext(path)[0] + ".csv"
-            df.to_csv(csv_path, index=False)
-            return csv_path
-    else:
-        df.to_csv(path, index=False)
-    return path
+            pf = pq.ParquetFile(old)
+            self._writer = pq.ParquetWriter(self.tmp, schema)
+            for i in range(pf.num_row_groups):
+                self._writer.write_table(conform(pf.read_row_group(i), schema))
+        finally:
+            os.remove(old)
+        added = [n for n in schema.names if n not in self.schema.names]
+        print(
+            f"[schema] {os.path.basename(self.path)}: widened"
+            + (f", added {','.join(added)}" if added else "")
+        )
+        self.schema = schema
+
+    def close(self):
+        """Rename into place; returns the path, or None if nothing was written."""
+        if self._writer is not None:
+            self._writer.close()
+        if not self._started:
+            return self.path if self.append else None
+        if self.rows == 0:
+            return None
+        os.replace(self.tmp, self.path)
+        return self.path
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def merge_outputs(paths, symbols, out_path, fmt, batch_rows=256_000):
+    """Stream per-symbol outputs into one file, adding a ``symbol`` column."""
+    schema = None
+    if fmt != "csv":
+        schema = pa.unify_schemas(
+            [pq.read_schema(p) for p in paths], promote_options="permissive"
+        ).append(pa.field("symbol", pa.string()))
+    out = ChunkWriter(out_path, fmt, schema)
+    try:
+        for path, sym in zip(paths, symbols):
+            if fmt == "csv":
+                batches = pd.read_csv(path, chunksize=batch_rows)
+            else:
+                pf = pq.ParquetFile(path)
+                batches = (
+                    b.to_pandas() for b in pf.iter_batches(batch_size=batch_rows)
+                )
+            for df in batches:
+                df["symbol"] = sym
+                out.add(df)
+    except Exception:
+        out.abort()
+        raise
+    return out.close(), out.rows
 
 
 # -------------------------- Fetcher --------------------------
 
 
+def output_tag(args):
+    dte_lo, dte_hi = args.dte
+    abs_lo, abs_hi = args.delta
+    return f"{args.start}_{args.end}_DTE{dte_lo}_{dte_hi}_Δ{abs_lo:g}_{abs_hi:g}"
+
+
+def output_path(args, name):
+    ext = "csv" if args.fmt == "csv" else "parquet"
+    outdir = args.outdir
+    if args.layout == "hive":
+        outdir = os.path.join(TMP_DIR, "ivol_staging")
+    return os.path.join(outdir, f"ivol_{name}_{output_tag(args)}.{ext}")
+
+
+def fetch_concurrent(
+    get_opts, symbols, units_for, args, limiter, on_unit, on_symbol, cache=None
+):
+    """Fetch all (symbol, cp, chunk) units on a thread pool.
+
+    ``args.concurrency`` calls are in flight at most, and ``limiter`` keeps
+    the global request rate. Units are drawn lazily, symbol by symbol,
+    through a bounded window. ``on_unit(unit, df, err)`` runs on the main
+    thread as each response arrives and ``on_symbol(sym)`` once all of a
+    symbol's units are done, so nothing is held in memory beyond the window.
+    """
+    remaining = {sym: 0 for sym in symbols}  # submitted, not yet returned
+    planned = set()  # symbols whose units have all been submitted
+    pending = {}  # future -> unit
+    window = 4 * args.concurrency
+
+    def plan():
+        for sym in symbols:
+            yield from units_for(sym)
+            planned.add(sym)
+            if remaining[sym] == 0:
+                on_symbol(sym)
+
+    units = plan()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        while True:
+            for unit in units:
+                sym, cp, cs, ce = unit
+                fut = ex.submit(
+                    fetch_unit,
+                    get_opts,
+                    sym,
+                    cp,
+                    cs,
+                    ce,
+                    args.dte,
+                    args.delta,
+                    limiter,
+                    args.retries,
+                    cache,
+                    args.row_limit,
+                )
+                remaining[sym] += 1
+                pending[fut] = unit
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                unit = pending.pop(fut)
+                try:
+                    on_unit(unit, fut.result(), None)
+                except Exception as e:
+                    on_unit(unit, None, e)
+                sym = unit[0]
+                remaining[sym] -= 1
+                if remaining[sym] == 0 and sym in planned:
+                    on_symbol(sym)
+
+
 def main():
     args = parse_args()
 
@@ -132,78 +730,186 @@ def main():
     if not api_key:
         raise SystemExit("Missing API key. Pass --key or set IVOL_API_KEY.")
 
+    if args.base_url:
+        ivol.setRestApiURL(args.base_url.rstrip("/"))
     ivol.setLoginParams(apiKey=api_key)
     get_opts = ivol.setMethod("/equities/eod/stock-opts-by-param")
 
-    dte_lo, dte_hi = args.dte
     abs_lo, abs_hi = args.delta
 
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ResponseCache(
+            Path(args.cache_dir) if args.cache_dir else DATA_DIR / "cache/ivol"
+        )
+
+    store = None
+    if args.store or args.store_dir or args.layout == "hive":
+        store = RawStore(
+            Path(args.store_dir) if args.store_dir else DATA_DIR / "store/ivol"
+        )
+
     symbols = load_symbols(args.tickers_csv)
     print(
         f"Symbols: {len(symbols)} found -> {symbols[:8]}{'...' if len(symbols)>8 else ''}"
     )
 
-    all_frames = []
+    writers = {}  # sym -> open ChunkWriter
+    results = {}  # sym -> [(unit, nrows, bytes, status, error)] for the ledger
+    resumed = set()  # symbols appending to an existing output
+    done = []  # (path, sym) of written per-symbol outputs
+
+    planner = ChunkPlanner(args.target_rows, args.chunk_days, args.max_chunk_days)
+
+    def units_for(sym):
+        """Lazily yield (sym, cp, start, end) units still to fetch."""
+        todo = {cp: [(args.start, args.end)] for cp in ("C", "P")}
+        if args.resume:
+            out = output_path(args, sym)
+            status = ledger.unit_status(sym, args.dte, args.delta, out)
+            # OK units live in the output file (hive: already merged into the
+            # store); EMPTY ones contributed no rows
+            ok = ("OK", "EMPTY")
+            if args.layout == "flat" and not os.path.exists(out):
+                ok = ("EMPTY",)
+            n_done = 0
+            for cp in todo:
+                finished = [
+                    (s, e) for (c, s, e), st in status.items() if c == cp and st in ok
+                ]
+                todo[cp] = date_gaps(args.start, args.end, finished)
+                n_done += len(finished)
+            has_ok = any(st == "OK" for st in status.values())
+            if args.layout == "flat" and has_ok and os.path.exists(out):
+                resumed.add(sym)
+            if n_done:
+                print(f"[RESUME] {sym}: {n_done} units done")
+        for cp in ("C", "P"):
+            if args.adaptive:
+                planner.seed(sym, cp, *ledger.density(sym, cp, args.dte, args.delta))
+            for gs, ge in todo[cp]:
+                if args.adaptive:
+                    windows = planner.windows(sym, cp, gs, ge)
+                else:
+                    windows = daterange_chunks(gs, ge, args.chunk_days)
+                for cs, ce in windows:
+                    yield (sym, cp, cs, ce)
 
-    for sym in symbols:
-        frames = []
-        for cs, ce in daterange_chunks(args.start, args.end, args.chunk_days):
-            for cp in ("C", "P"):
-                dlo, dhi = delta_band(cp, abs_lo, abs_hi)
+    def add_chunk(unit, df, err):
+        sym, cp, cs, ce = unit
+        res = results.setdefault(sym, [])
+        if err is None:
+            planner.observe(sym, cp, cs, ce, 0 if df is None else len(df))
+        if err is not None:
+            print(f"[WARN] {sym} {cp} {cs}->{ce}: {err}")
+            res.append((unit, 0, 0, "ERROR", str(err)))
+            return
+        if df is None or len(df) == 0:
+            res.append((unit, 0, 0, "EMPTY", None))
+            return
+        # chunks never overlap (disjoint dates, one cp each), so per-chunk
+        # dedup + band check equals the old whole-symbol pass
+        if sym not in writers:
+            writers[sym] = ChunkWriter(
+                output_path(args, sym), args.fmt, append=sym in resumed
+            )
+        try:
+            out_df = in_band(dedup(df), abs_lo, abs_hi)
+            writers[sym].add(out_df)
+        except Exception as e:
+            print(f"[WARN] {sym}: chunk not written: {e}")
+            res.append((unit, 0, 0, "ERROR", str(e)))
+            return
+        nbytes = int(df.memory_usage(index=False).sum())
+        res.append((unit, len(out_df), nbytes, "OK" if len(out_df) else "EMPTY", None))
+
+    def finish_symbol(sym):
+        w = writers.pop(sym, None)
+        if w is None and sym in resumed and os.path.exists(output_path(args, sym)):
+            w = ChunkWriter(output_path(args, sym), args.fmt, append=True)
+        written = w.close() if w is not None else None
+        merged = None
+        if store is not None and written is not None and w.rows:
+            merged = store.merge_file(written, sym)
+        if args.layout == "hive" and written is not None:
+            os.remove(written)  # staging only; the rows are in the store now
+        # units count as done only once their rows are in the renamed file
+        out = str(output_path(args, sym))
+        if sym not in resumed and args.layout == "flat":
+            ledger.supersede(out)  # the file was rewritten from scratch
+        units = results.pop(sym, [])
+        for (_, cp, cs, ce), nrows, nbytes, status, error in units:
+            extra = {"out": out, "chunk_days": args.chunk_days}
+            if error:
+                extra["error"] = error
+            ledger.record(
+                sym, cs, ce, args.dte, args.delta, nrows, nbytes, status, extra, cp=cp
+            )
+        if written is None and not units:
+            print(f"[OK] {sym}: nothing left to fetch")
+            return
+        if written is None:
+            print(f"[SKIP] {sym}: no data returned for given filters.")
+            return
+        if args.layout == "flat":
+            if w.rows:
+                print(f"[OK] {sym}: {w.rows:,} rows -> {written}")
+            else:
+                print(f"[OK] {sym}: unchanged -> {written}")
+            done.append((written, sym))
+        if merged is not None:
+            inserted, dupes = merged
+            print(f"[store] {sym}: +{inserted:,} rows, {dupes:,} duplicates dropped")
+
+    if args.concurrency <= 1:
+        limiter = TokenBucket(args.rps, args.burst) if args.rps else None
+        for sym in symbols:
+            for unit in units_for(sym):
+                _, cp, cs, ce = unit
                 # Fetch
                 try:
-                    df = get_opts(
-                        symbol=sym,
-                        cp=cp,
-                        startDate=cs,
-                        endDate=ce,
-                        dteFrom=dte_lo,
-                        dteTo=dte_hi,
-                        deltaFrom=dlo,
-                        deltaTo=dhi,
+                    df = fetch_unit(
+                        get_opts,
+                        sym,
+                        cp,
+                        cs,
+                        ce,
+                        args.dte,
+                        args.delta,
+                        limiter,
+                        args.retries,
+                        cache,
+                        args.row_limit,
                     )
+                    add_chunk(unit, df, None)
                 except Exception as e:
-                    print(f"[WARN] {sym} {cp} {cs}->{ce}: {e}")
-                    df = pd.DataFrame()
-                if df is not None and len(df) > 0:
-                    frames.append(df)
-                time.sleep(args.sleep)
-        if frames:
-            out_df = dedup(pd.concat(frames, ignore_index=True))
-            # optional sanity: keep only rows truly in-band
-            if "delta" in out_df.columns:
-                # calls should be >= +abs_lo for cp=='C'; puts <= -abs_lo for cp=='P'
-                mask = []
-                if "call_put" in out_df.columns:
-                    cpcol = out_df["call_put"].astype(str)
-                    mask = (
-                        (cpcol == "C")
-                        & (out_df["delta"].between(abs_lo, abs_hi, inclusive="both"))
-                    ) | (
-                        (cpcol == "P")
-                        & (out_df["delta"].between(-abs_hi, -abs_lo, inclusive="both"))
-                    )
-                    out_df = out_df[mask]
-            # write per-symbol
-            tag = f"{args.start}_{args.end}_DTE{dte_lo}_{dte_hi}_Δ{abs_lo:g}_{abs_hi:g}"
-            out_name = f"ivol_{sym}_{tag}.{args.fmt if args.fmt=='csv' else 'parquet'}"
-            out_path = os.path.join(args.outdir, out_name)
-            written = write_frame(out_df, out_path, args.fmt)
-            print(f"[OK] {sym}: {len(out_df):,} rows -> {written}")
-            if args.combine:
-                out_df = out_df.copy()
-                out_df["symbol"] = sym
-                all_frames.append(out_df)
-        else:
-            print(f"[SKIP] {sym}: no data returned for given filters.")
+                    add_chunk(unit, None, e)
+                if limiter is None:
+                    time.sleep(args.sleep)
+            finish_symbol(sym)
+    else:
+        rps = args.rps or (1.0 / args.sleep if args.sleep > 0 else 1e9)
+        limiter = TokenBucket(rps, args.burst)
+        fetch_concurrent(
+            get_opts,
+            symbols,
+            units_for,
+            args,
+            limiter,
+            add_chunk,
+            finish_symbol,
+            cache,
+        )
 
-    if args.combine and all_frames:
-        combo = dedup(pd.concat(all_frames, ignore_index=True))
-        tag = f"{args.start}_{args.end}_DTE{dte_lo}_{dte_hi}_Δ{abs_lo:g}_{abs_hi:g}"
-        combo_name = f"ivol_ALL_{tag}.{args.fmt if args.fmt=='csv' else 'parquet'}"
-        combo_path = os.path.join(args.outdir, combo_name)
-        written = write_frame(combo, combo_path, args.fmt)
-        print(f"[OK] combined: {len(combo):,} rows -> {written}")
+    if args.combine and args.layout == "hive":
+        print(f"[OK] combined: the store is the combined view -> {store.root}")
+    elif args.combine and done:
+        # streamed merge of the per-symbol files: constant memory
+        paths, syms = zip(*done)
+        written, nrows = merge_outputs(paths, syms, output_path(args, "ALL"), args.fmt)
+        print(f"[OK] combined: {nrows:,} rows -> {written}")
+    if cache is not None:
+        print(cache.summary())
 
 
 if __name__ == "__main__":
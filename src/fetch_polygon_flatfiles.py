@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # src/fetch_polygon_flatfiles.py
 import os
+import io
+import threading
+import time
 import argparse
 import gzip
+from datetime import date
 from io import BytesIO
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -13,11 +17,108 @@ import pandas as pd
 from dotenv import load_dotenv
 import pandas_market_calendars as mcal
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 import gc
 
+from flatfile_cache import FlatfileCache, NotCached, head_etag
+from manifest import Manifest, fingerprint
+
 # --------- helpers ---------
 
+# Explicit types for us_stocks_sip/minute_aggs_v1 (arrow engine). Columns not
+# listed here are still read, with types inferred from the first block.
+MINUTE_AGGS_TYPES = {
+    "ticker": pa.string(),
+    "volume": pa.int64(),
+    "open": pa.float64(),
+    "close": pa.float64(),
+    "high": pa.float64(),
+    "low": pa.float64(),
+    "window_start": pa.int64(),
+    "transactions": pa.int64(),
+}
+
+
+# Flatfile prefixes per --dataset
+DATASETS = {
+    "stocks": "us_stocks_sip/minute_aggs_v1",
+    "options": "us_options_opra/minute_aggs_v1",
+}
+
+
+def parse_occ(symbols: pa.Array) -> dict[str, pa.Array]:
+    """Split OCC option tickers (``O:SPY241220C00500000``) into typed columns.
+
+    Fully vectorized: the last 15 chars are always YYMMDD + C/P + strike*1000
+    (8 digits), the root is whatever sits between ``O:`` and that suffix.
+    """
+    expiry = pc.strptime(
+        pc.utf8_slice_codeunits(symbols, -15, -9), format="%y%m%d", unit="s"
+    )
+    strike = pc.cast(pc.utf8_slice_codeunits(symbols, -8, 1 << 30), pa.int64())
+    return {
+        "underlying": pc.utf8_slice_codeunits(symbols, 2, -15),
+        "expiration_date": pc.cast(expiry, pa.date32()),
+        "call_put": pc.utf8_slice_codeunits(symbols, -9, -8),
+        "price_strike": pc.divide(pc.cast(strike, pa.float64()), 1000.0),
+    }
+
+
+def compact_types(price_type: str = "float64") -> dict[str, pa.DataType]:
+    """Fixed output schema for --compact: dictionary ticker, int32 counts."""
+    px = pa.float32() if price_type == "float32" else pa.float64()
+    return {
+        "ticker": pa.dictionary(pa.int32(), pa.string()),
+        "underlying": pa.dictionary(pa.int32(), pa.string()),
+        "call_put": pa.dictionary(pa.int8(), pa.string()),
+        "volume": pa.int64(),
+        "open": px,
+        "close": px,
+        "high": px,
+        "low": px,
+        "window_start": pa.int64(),
+        "transactions": pa.int32(),
+    }
+
+
+COMPACT_DICT_COLS = ("ticker", "underlying", "call_put")
+
+
+def cast_compact(t: pa.Table, compact: dict) -> pa.Table:
+    """Cast one part to the compact types, dictionary columns left as strings.
+
+    Parts are cast one by one (pandas chunks may infer different dtypes); the
+    ticker is dictionary-encoded only after the sort.
+    """
+    types = compact_types(compact.get("price_type", "float64"))
+    for i, name in enumerate(t.column_names):
+        if name in types and name not in COMPACT_DICT_COLS:
+            t = t.set_column(i, name, t[name].cast(types[name]))
+    return t.replace_schema_metadata(None)
+
+
+def compact_row_groups(table: pa.Table, compact: dict):
+    """Yield ``table`` sorted by ticker/window_start, one row group at a time.
+
+    Only the sort indices and the current row group are materialized, so
+    ``table`` can be a memory-mapped spill file rather than a heap copy.
+    """
+    types = compact_types(compact.get("price_type", "float64"))
+    keys = [("ticker", "ascending")]
+    if "window_start" in table.column_names:
+        keys.append(("window_start", "ascending"))
+    order = pc.sort_indices(table, sort_keys=keys)
+    step = compact.get("row_group_rows") or 65_536
+    for lo in range(0, len(order), step):
+        rg = cast_compact(table.take(order.slice(lo, step)), compact)
+        for name in COMPACT_DICT_COLS:
+            if name in rg.column_names:
+                i = rg.column_names.index(name)
+                rg = rg.set_column(i, name, rg[name].cast(types[name]))
+        yield rg
+
 
 def load_tickers(path: str) -> set[str]:
     df = pd.read_csv(path)
@@ -44,9 +145,10 @@ def mk_s3():
         connect_timeout=10,
     )
     # return boto3.client("s3", endpoint_url="https://files.polygon.io", config=cfg)
+    # POLY_S3_ENDPOINT lets you point at a local S3 stand-in (minio, moto) for tests
     return boto3.client(
         "s3",
-        endpoint_url="https://files.polygon.io",
+        endpoint_url=os.getenv("POLY_S3_ENDPOINT", "https://files.polygon.io"),
         aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID") or os.getenv("AWS_KEY"),
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
         or os.getenv("AWS_SECRET"),
@@ -54,76 +156,513 @@ def mk_s3():
     )
 
 
-def key_for(date_str: str) -> tuple[str, str]:
+def key_for(date_str: str, dataset: str = "stocks") -> tuple[str, str]:
     y, m, _ = date_str.split("-")
-    prefix = "us_stocks_sip/minute_aggs_v1"
+    prefix = DATASETS[dataset]
     return "flatfiles", f"{prefix}/{y}/{m}/{date_str}.csv.gz"
 
 
+def load_universes(specs: list[str]) -> dict[str, set[str]]:
+    """Parse repeated ``NAME=path.csv`` specs into {name: tickers}."""
+    universes = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep or not name or not path:
+            raise ValueError(f"--universe expects NAME=CSV, got {spec!r}")
+        if name in universes:
+            raise ValueError(f"duplicate universe name {name!r}")
+        universes[name] = load_tickers(path)
+    return universes
+
+
+def out_name(date_str: str, universe: str = "spx") -> str:
+    return f"{date_str}_{universe}_1m.parquet"
+
+
+def day_dir(base: Path, date_str: str, hive: bool = False) -> Path:
+    """Output dir for a day; hive=True adds year=YYYY/month=MM partitions."""
+    if not hive:
+        return base
+    y, m, _ = date_str.split("-")
+    return base / f"year={y}" / f"month={m}"
+
+
+def universe_targets(
+    universes: dict[str, set[str]], outdir: Path, date_str: str, hive: bool = False
+) -> dict[str, tuple[set[str], Path]]:
+    """{name: (tickers, out path)} for one day; one subdir per universe."""
+    return {
+        name: (tk, day_dir(outdir / name, date_str, hive) / out_name(date_str, name))
+        for name, tk in universes.items()
+    }
+
+
+def sync_reason(
+    manifest: Manifest,
+    s3,
+    date_str: str,
+    targets: dict[str, tuple[set[str], Path]],
+    keep_cols=None,
+    check_etag: bool = False,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+    verify: bool = False,
+) -> str:
+    """'OK' if every target for the day is current in the manifest, else why not.
+
+    Outputs are only checksummed with ``verify``; otherwise a target counts
+    as current when its file exists. A target recorded under another path
+    (e.g. flat before, ``--hive`` now) is reported as MOVED.
+    """
+    source = None
+    for name, (tk, out) in targets.items():
+        part = f"{date_str}/{name}"
+        why = manifest.check(
+            part,
+            params=target_params(tk, keep_cols, compact, dataset),
+            verify=verify,
+        )
+        if why != "OK":
+            return why
+        path = manifest.get(part)["path"]
+        if path is not None and Path(path) != out:
+            return "MOVED"
+        if check_etag:
+            if source is None:
+                try:
+                    source = head_etag(s3, *key_for(date_str, dataset))
+                except Exception:
+                    return "STALE"
+            if manifest.get(part)["source"] != source:
+                return "STALE"
+    return "OK"
+
+
 def ensure_outdir(base: Path) -> Path:
     base.mkdir(parents=True, exist_ok=True)
     return base
 
 
+class BodyReader(io.RawIOBase):
+    """Read-only raw stream over an S3 ``StreamingBody``.
+
+    Lets ``io.BufferedReader`` + ``gzip.GzipFile`` pull the object a buffer at a
+    time instead of materializing the whole ``.csv.gz`` with ``Body.read()``.
+    """
+
+    def __init__(self, body):
+        self._body = body
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._body.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        try:
+            self._body.close()
+        finally:
+            super().close()
+
+
+def open_body(obj, stream: bool, buf_bytes: int = 1 << 20):
+    """Compressed byte stream over a get_object() response.
+
+    stream=False reads the whole compressed object into memory (old behaviour);
+    stream=True pulls it through a ``buf_bytes`` read buffer, so memory is
+    bounded by the buffer + parse chunk, not the file size.
+    """
+    if not stream:
+        return BytesIO(obj["Body"].read())
+    return io.BufferedReader(BodyReader(obj["Body"]), buffer_size=buf_bytes)
+
+
 def save_parquet(df: pd.DataFrame, outdir: Path, date_str: str) -> Path:
-    out = outdir / f"{date_str}_spx_1m.parquet"
+    out = outdir / out_name(date_str)
     df.to_parquet(out, index=False, compression="zstd")
     return out
 
 
+# --------- parse engines ---------
+def iter_tables_pandas(gz, tickers: set[str], keep_cols=None, chunk_rows=200_000):
+    """pandas engine: chunked read_csv -> upper/isin filter -> Arrow table."""
+    reader = pd.read_csv(
+        gz,
+        usecols=keep_cols,  # e.g. ["ticker","t","o","h","l","c","v","n","vw"]
+        chunksize=chunk_rows,  # tune down if still tight on RAM
+    )
+    for chunk in reader:
+        if "ticker" not in chunk.columns:
+            raise ValueError("no_ticker_col")
+        chunk["ticker"] = chunk["ticker"].astype(str).str.upper()
+        chunk = chunk[chunk["ticker"].isin(tickers)]
+        if chunk.empty:
+            continue
+        # (optional) add ts_utc from 't' once you need it:
+        # if "t" in chunk.columns:
+        #     chunk["ts_utc"] = pd.to_datetime(chunk["t"], unit="ms", utc=True)
+
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        del chunk
+        yield table
+        gc.collect()
+
+
+def iter_tables_arrow(
+    src,
+    tickers: set[str],
+    keep_cols=None,
+    block_bytes=16 << 20,
+    dataset: str = "stocks",
+):
+    """arrow engine: multithreaded streaming CSV reader with a fixed schema.
+
+    Each record batch is filtered with a hash lookup (``is_in``) against the
+    ticker set and yielded as-is; no pandas round-trip, no per-chunk GC.
+
+    For ``dataset="options"`` the set holds underlyings: each batch's OCC
+    symbols are parsed, filtered on the parsed root, and only surviving
+    contracts get underlying/expiration_date/call_put/price_strike columns.
+    """
+    read_opts = pacsv.ReadOptions(block_size=block_bytes, use_threads=True)
+    conv_opts = pacsv.ConvertOptions(
+        column_types=MINUTE_AGGS_TYPES, include_columns=keep_cols
+    )
+    value_set = pa.array(sorted(tickers), type=pa.string())
+    with pacsv.open_csv(
+        src, read_options=read_opts, convert_options=conv_opts
+    ) as reader:
+        names = reader.schema.names
+        if "ticker" not in names:
+            raise ValueError("no_ticker_col")
+        i_tk = names.index("ticker")
+        for batch in reader:
+            sym = pc.utf8_upper(batch.column(i_tk))
+            if dataset == "options":
+                root = pc.utf8_slice_codeunits(sym, 2, -15)
+                mask = pc.is_in(root, value_set=value_set)
+            else:
+                mask = pc.is_in(sym, value_set=value_set)
+            if not pc.any(mask).as_py():
+                continue
+            table = pa.Table.from_batches([batch])
+            table = table.set_column(i_tk, "ticker", sym).filter(mask)
+            if dataset == "options":
+                for name, col in parse_occ(table["ticker"].combine_chunks()).items():
+                    table = table.append_column(name, col)
+            yield table
+
+
 # --------- core ---------
-def fetch_one_day(s3, date_str: str, tickers: set[str], outdir: Path, keep_cols=None):
-    bucket, key = key_for(date_str)
+def fetch_one_day(
+    s3,
+    date_str: str,
+    tickers: set[str],
+    outdir: Path,
+    keep_cols=None,
+    stream: bool = False,
+    chunk_rows: int = 200_000,
+    buf_bytes: int = 1 << 20,
+    engine: str = "pandas",
+    block_bytes: int = 16 << 20,
+    cache: FlatfileCache | None = None,
+    offline: bool = False,
+    manifest: Manifest | None = None,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+):
+    targets = {"spx": (tickers, outdir / out_name(date_str))}
+    return fetch_day_targets(
+        s3,
+        date_str,
+        targets,
+        keep_cols=keep_cols,
+        stream=stream,
+        chunk_rows=chunk_rows,
+        buf_bytes=buf_bytes,
+        engine=engine,
+        block_bytes=block_bytes,
+        cache=cache,
+        offline=offline,
+        manifest=manifest,
+        compact=compact,
+        dataset=dataset,
+    )
+
+
+def target_params(
+    tickers: set[str], keep_cols=None, compact=None, dataset: str = "stocks"
+) -> str:
+    """Fingerprint of what a target file was filtered with (for the manifest)."""
+    params = {"tickers": sorted(tickers), "cols": keep_cols}
+    if compact:
+        params["compact"] = compact
+    if dataset != "stocks":
+        params["dataset"] = dataset
+    return fingerprint(params)
+
+
+def fetch_day_targets(
+    s3,
+    date_str: str,
+    targets: dict[str, tuple[set[str], Path]],
+    keep_cols=None,
+    stream: bool = False,
+    chunk_rows: int = 200_000,
+    buf_bytes: int = 1 << 20,
+    engine: str = "pandas",
+    block_bytes: int = 16 << 20,
+    cache: FlatfileCache | None = None,
+    offline: bool = False,
+    manifest: Manifest | None = None,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+):
+    """Download + parse one day once and route rows to every target.
+
+    ``targets`` maps a universe name to (tickers, output parquet path). The
+    parse filters on the union of all universes; each universe then gets a
+    cheap ``is_in`` filter over the already-reduced batch.
+
+    With ``cache`` the raw object is served from / stored in the local
+    flatfile cache; ``offline`` never contacts S3 and reports UNCACHED on a miss.
+
+    Files are written to ``<out>.tmp`` and renamed into place only once the
+    whole day parsed cleanly. With ``manifest`` each target is recorded as
+    ``<date>/<name>`` with source ETag, rows, schema and checksum.
+
+    ``compact`` ({"price_type", "row_group_rows"}) switches the output to the
+    fixed compact schema, sorted by ticker then time (see parse_to_tmp).
+
+    ``dataset`` picks the flatfile (stocks or options minute aggs); for options
+    ticker sets are matched against the OCC underlying.
+    """
     try:
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        raw = obj["Body"].read()
+        body, etag = open_day(s3, date_str, stream, buf_bytes, cache, offline, dataset)
+    except NotCached:
+        return date_str, "UNCACHED"
     except s3.exceptions.NoSuchKey:  # type: ignore[attr-defined]
         return date_str, "MISSING"
     except Exception as e:
         return date_str, f"ERROR:{e}"
 
-    # stream gzip → chunks
-    rows_written = 0
-    out = outdir / f"{date_str}_spx_1m.parquet"
-    writer = None
+    try:
+        written = parse_to_tmp(
+            body,
+            targets,
+            keep_cols,
+            engine,
+            chunk_rows,
+            block_bytes,
+            compact,
+            dataset,
+            date_str,
+        )
+    except Exception as e:
+        # in stream mode network errors surface mid-parse
+        return date_str, f"ERROR:{e}"
+    return commit_targets(
+        date_str, targets, written, etag, keep_cols, manifest, compact, dataset
+    )
+
+
+def open_day(
+    s3,
+    date_str: str,
+    stream: bool = False,
+    buf_bytes: int = 1 << 20,
+    cache: FlatfileCache | None = None,
+    offline: bool = False,
+    dataset: str = "stocks",
+):
+    """(compressed body, etag) for one day; raises NoSuchKey / NotCached."""
+    bucket, key = key_for(date_str, dataset)
+    if cache is not None:
+        return cache.open(s3, bucket, key, offline=offline, buf_bytes=buf_bytes)
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    etag = obj.get("ETag", "").strip('"')
+    return open_body(obj, stream, buf_bytes), etag
+
+
+def tmp_path(out: Path) -> Path:
+    """Per-process/thread temp name next to ``out``, so concurrent runs don't clash."""
+    return out.with_name(f"{out.name}.{os.getpid()}.{threading.get_ident()}.tmp")
 
+
+def write_compact(table: pa.Table, dst: Path, compact: dict) -> str:
+    """Write ``table`` in the compact layout to ``dst``; returns the schema string."""
+    writer = None
     try:
-        with gzip.GzipFile(fileobj=BytesIO(raw)) as gz:
-            reader = pd.read_csv(
-                gz,
-                usecols=keep_cols,  # e.g. ["ticker","t","o","h","l","c","v","n","vw"]
-                chunksize=200_000,  # tune down if still tight on RAM
-            )
-            for chunk in reader:
-                if "ticker" not in chunk.columns:
-                    return date_str, "ERROR:no_ticker_col"
-                chunk["ticker"] = chunk["ticker"].astype(str).str.upper()
-                chunk = chunk[chunk["ticker"].isin(tickers)]
-                if chunk.empty:
-                    continue
-                # (optional) add ts_utc from 't' once you need it:
-                # if "t" in chunk.columns:
-                #     chunk["ts_utc"] = pd.to_datetime(chunk["t"], unit="ms", utc=True)
-
-                table = pa.Table.from_pandas(chunk, preserve_index=False)
-                if writer is None:
-                    writer = pq.ParquetWriter(out, table.schema, compression="zstd")
-                writer.write_table(table)
-                rows_written += len(chunk)
-                del chunk, table
-                gc.collect()
+        for rg in compact_row_groups(table, compact):
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    dst, rg.schema, compression="zstd", write_page_index=True
+                )
+            writer.write_table(rg, row_group_size=rg.num_rows)
     finally:
         if writer is not None:
             writer.close()
+    return writer.schema.to_string()
+
+
+def parse_to_tmp(
+    body,
+    targets: dict[str, tuple[set[str], Path]],
+    keep_cols=None,
+    engine: str = "pandas",
+    chunk_rows: int = 200_000,
+    block_bytes: int = 16 << 20,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+    c_date: str | None = None,
+    ipc: bool = False,
+) -> dict[str, tuple[int, str | None]]:
+    """Gunzip + parse + filter ``body`` into each target's ``.tmp`` file.
+
+    Default: batches are streamed to the writer as parsed. With ``compact``
+    each target's (already filtered) day is cast to the compact schema and
+    spilled to an Arrow IPC file next to the output; that file is then
+    memory-mapped, sorted by ticker/window_start and written in row groups of
+    ``row_group_rows`` with a page index, so per-ticker predicates prune.
+    Resident memory is the sort indices plus one row group, not the day.
+
+    Options rows carry the parsed OCC columns plus ``c_date`` (the trade
+    date), named like the IVol raw files so the sql/ pipeline can join them.
+
+    ``ipc`` writes uncompressed Arrow IPC streams instead of Parquet and
+    ignores ``compact``; the pipeline's write stage encodes them later.
+
+    Returns {name: (rows, schema string)}; on error the temp files are removed
+    and the exception propagates.
+    """
+    union = set().union(*(tk for tk, _ in targets.values()))
+    key_col = "underlying" if dataset == "options" else "ticker"
+    # stream gzip → chunks
+    if engine == "arrow":
+        # gunzip in Arrow's C++ stream, off the GIL
+        src = pa.CompressedInputStream(pa.PythonFile(body, mode="r"), "gzip")
+        tables = iter_tables_arrow(src, union, keep_cols, block_bytes, dataset)
+    elif dataset == "options":
+        raise ValueError("options dataset needs --engine arrow")
+    else:
+        src = gzip.GzipFile(fileobj=body)
+        tables = iter_tables_pandas(src, union, keep_cols, chunk_rows)
+
+    value_sets = {
+        name: pa.array(sorted(tk), type=pa.string())
+        for name, (tk, _) in targets.items()
+    }
+    rows_written = {name: 0 for name in targets}
+    writers: dict = {}
+    schemas: dict[str, str] = {}
+    tmps = {name: tmp_path(out) for name, (_, out) in targets.items()}
+    spills = {}
+    if compact and not ipc:
+        spills = {name: t.with_name(t.name + ".arrows") for name, t in tmps.items()}
 
-    if rows_written == 0:
-        # no matches; remove empty file if created
-        try:
-            out.unlink(missing_ok=True)
-        except Exception:
-            pass
+    try:
+        with src:
+            for table in tables:
+                if c_date is not None and dataset == "options":
+                    day = pa.scalar(date.fromisoformat(c_date), type=pa.date32())
+                    table = table.append_column(
+                        "c_date", pa.repeat(day, table.num_rows)
+                    )
+                for name, (_, out) in targets.items():
+                    part = table
+                    if len(targets) > 1:
+                        mask = pc.is_in(part[key_col], value_set=value_sets[name])
+                        part = part.filter(mask)
+                        if part.num_rows == 0:
+                            continue
+                    rows_written[name] += part.num_rows
+                    if spills:
+                        part = cast_compact(part, compact)
+                    if name not in writers:
+                        out.parent.mkdir(parents=True, exist_ok=True)
+                        if ipc or spills:
+                            writers[name] = pa.ipc.new_stream(
+                                str(spills.get(name, tmps[name])), part.schema
+                            )
+                        else:
+                            writers[name] = pq.ParquetWriter(
+                                tmps[name], part.schema, compression="zstd"
+                            )
+                        schemas[name] = part.schema.to_string()
+                    writers[name].write_table(part)
+                del table
+        for name, spill in spills.items():
+            if name not in writers:
+                continue
+            writers.pop(name).close()
+            with pa.memory_map(str(spill)) as src:
+                table = pa.ipc.open_stream(src).read_all()
+                schemas[name] = write_compact(table, tmps[name], compact)
+                del table
+    except Exception:
+        # drop the partial files
+        for w in writers.values():
+            w.close()
+        writers = {}
+        for tmp in tmps.values():
+            tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        for w in writers.values():
+            w.close()
+        for spill in spills.values():
+            spill.unlink(missing_ok=True)
+
+    return {name: (rows_written[name], schemas.get(name)) for name in targets}
+
+
+def commit_targets(
+    date_str: str,
+    targets: dict[str, tuple[set[str], Path]],
+    written: dict[str, tuple[int, str | None]],
+    etag: str | None,
+    keep_cols=None,
+    manifest: Manifest | None = None,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+) -> tuple[str, str]:
+    """Rename ``.tmp`` files into place, update the manifest, build the status."""
+    for name, (tk, out) in targets.items():
+        rows, schema = written[name]
+        if rows == 0:
+            # no matches; remove a previous file for this day if any
+            try:
+                out.unlink(missing_ok=True)
+            except Exception:
+                pass
+        else:
+            os.replace(tmp_path(out), out)
+        if manifest is not None:
+            prev = manifest.get(f"{date_str}/{name}")
+            if prev and prev["path"] and Path(prev["path"]) != out:
+                # layout changed (--hive toggled); don't leave the old copy behind
+                Path(prev["path"]).unlink(missing_ok=True)
+            manifest.record(
+                f"{date_str}/{name}",
+                out if rows else None,
+                source=etag,
+                params=target_params(tk, keep_cols, compact, dataset),
+                nrows=rows,
+                schema=schema,
+                status="OK" if rows else "EMPTY",
+            )
+
+    if not any(rows for rows, _ in written.values()):
         return date_str, "EMPTY"
-    return date_str, f"OK:{rows_written}->{out.name}"
+    if len(targets) == 1:
+        ((name, (_, out)),) = targets.items()
+        return date_str, f"OK:{written[name][0]}->{out.name}"
+    parts = ",".join(f"{name}={n or 'EMPTY'}" for name, (n, _) in written.items())
+    return date_str, f"OK:{parts}"
 
 
 def fetch_one_day_old(
@@ -167,10 +706,27 @@ def main():
         description="Fetch Polygon flatfiles 1m, filter to tickers, write daily Parquet."
     )
     p.add_argument("--start", required=True, help="YYYY-MM-DD")
+    p.add_argument(
+        "--dataset",
+        choices=sorted(DATASETS),
+        default="stocks",
+        help="stocks (minute_aggs) or options (OPRA minute aggs filtered by"
+        " underlying; needs --engine arrow)",
+    )
     p.add_argument("--end", required=True, help="YYYY-MM-DD")
-    p.add_argument("--tickers", required=True, help="CSV with Symbol/ticker column")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--tickers", help="CSV with Symbol/ticker column")
+    src.add_argument(
+        "--universe",
+        action="append",
+        metavar="NAME=CSV",
+        help="Named ticker universe (repeatable); each day is downloaded and"
+        " parsed once and written to <outdir>/NAME/<date>_NAME_1m.parquet",
+    )
     p.add_argument(
-        "--outdir", default=None, help="Output dir (default: ${POLY_DATA_DIR}/raw)"
+        "--outdir",
+        default=None,
+        help="Output dir (default: ${POLY_DATA_DIR}/raw, or raw_options for options)",
     )
     p.add_argument(
         "--workers", type=int, default=4, help="Parallel days to fetch (default 4)"
@@ -181,36 +737,259 @@ def main():
         default=None,
         help="Optional column subset to keep (e.g. ticker t o h l c v n vw)",
     )
+    p.add_argument(
+        "--stream",
+        action="store_true",
+        help="Decompress/parse the S3 body incrementally (memory bounded by chunk size)",
+    )
+    p.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=200_000,
+        help="CSV rows per parse chunk (default 200000)",
+    )
+    p.add_argument(
+        "--buf-mb",
+        type=float,
+        default=1.0,
+        help="Read buffer per worker in MB for --stream (default 1)",
+    )
+    p.add_argument(
+        "--engine",
+        choices=["pandas", "arrow"],
+        default="pandas",
+        help="CSV parse engine: pandas chunked read_csv or Arrow streaming reader",
+    )
+    p.add_argument(
+        "--block-mb",
+        type=float,
+        default=16.0,
+        help="Arrow CSV block size in MB for --engine arrow (default 16)",
+    )
+    p.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache raw .csv.gz objects locally (keyed by bucket/key/ETag)",
+    )
+    p.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Raw object cache dir (default: ${POLY_DATA_DIR}/cache/flatfiles)",
+    )
+    p.add_argument(
+        "--cache-gb",
+        type=float,
+        default=None,
+        help="Cache size cap in GB; least recently used objects are evicted",
+    )
+    p.add_argument(
+        "--offline",
+        action="store_true",
+        help="Serve only from the local cache, never contact S3",
+    )
+    p.add_argument(
+        "--sync",
+        action="store_true",
+        help="Incremental: skip days already in the output manifest and valid",
+    )
+    p.add_argument(
+        "--check-etag",
+        action="store_true",
+        help="With --sync, HEAD completed days and redo those whose source changed",
+    )
+    p.add_argument(
+        "--verify",
+        action="store_true",
+        help="With --sync, also checksum existing outputs and redo corrupt ones",
+    )
+    p.add_argument(
+        "--compact",
+        action="store_true",
+        help="Fixed compact schema (dictionary ticker, int32 counts), rows sorted"
+        " by ticker/time, row groups sized for per-ticker pushdown (the day is"
+        " spilled to disk and sorted a row group at a time)",
+    )
+    p.add_argument(
+        "--price-type",
+        choices=["float32", "float64"],
+        default="float64",
+        help="--compact: dtype for open/high/low/close (default float64)",
+    )
+    p.add_argument(
+        "--row-group-rows",
+        type=int,
+        default=65_536,
+        help="--compact: rows per Parquet row group (default 65536)",
+    )
+    p.add_argument(
+        "--hive",
+        action="store_true",
+        help="Write days under year=YYYY/month=MM/ partitions",
+    )
+    p.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Pipelined executor: download threads -> parse processes -> writer",
+    )
+    p.add_argument(
+        "--dl-workers",
+        type=int,
+        default=4,
+        help="--pipeline: concurrent downloads (default 4)",
+    )
+    p.add_argument(
+        "--parse-workers",
+        type=int,
+        default=None,
+        help="--pipeline: parse processes (default: CPU count)",
+    )
+    p.add_argument(
+        "--queue",
+        type=int,
+        default=None,
+        help="--pipeline: max spooled + in-flight days (default 2 x parse workers)",
+    )
     args = p.parse_args()
 
     data_root = Path(os.getenv("POLY_DATA_DIR", f"{Path.home()}/polydata")).expanduser()
-    outdir = ensure_outdir(Path(args.outdir) if args.outdir else (data_root / "raw"))
-
-    tickers = load_tickers(args.tickers)
+    default_out = "raw_options" if args.dataset == "options" else "raw"
+    outdir = ensure_outdir(
+        Path(args.outdir) if args.outdir else (data_root / default_out)
+    )
+    if args.dataset == "options" and args.engine != "arrow":
+        p.error("--dataset options requires --engine arrow")
+
+    if args.universe:
+        universes = load_universes(args.universe)
+    else:
+        universes = None
+        tickers = load_tickers(args.tickers)
     dates = [d.strftime("%Y-%m-%d") for d in nyse_dates(args.start, args.end)]
 
     # S3 client (uses env AWS_KEY/AWS_SECRET if required by your Polygon account)
     s3 = mk_s3()
 
-    print(f"[cfg] days={len(dates)} tickers={len(tickers)} outdir={outdir}")
-    statuses = []
-    # Parallel across days (keeps memory low and S3-friendly)
-    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
-        futs = {
-            ex.submit(fetch_one_day, s3, ds, tickers, outdir, args.cols): ds
-            for ds in dates
+    cache = None
+    if args.cache or args.cache_dir or args.offline:
+        cache = FlatfileCache(
+            Path(args.cache_dir) if args.cache_dir else data_root / "cache/flatfiles",
+            max_bytes=int(args.cache_gb * (1 << 30)) if args.cache_gb else None,
+        )
+        n, size = cache.stats()
+        print(
+            f"[cache] {cache.root} objects={n} size={size / (1 << 30):.2f}GB"
+            f" offline={args.offline}"
+        )
+
+    def targets_for(ds: str) -> dict[str, tuple[set[str], Path]]:
+        if universes:
+            return universe_targets(universes, outdir, ds, args.hive)
+        return {"spx": (tickers, day_dir(outdir, ds, args.hive) / out_name(ds))}
+
+    compact = None
+    if args.compact:
+        compact = {
+            "price_type": args.price_type,
+            "row_group_rows": args.row_group_rows,
         }
-        for fut in as_completed(futs):
-            ds, st = fut.result()
-            statuses.append((ds, st))
-            print(f"[{ds}] {st}")
+
+    if universes:
+        desc = " ".join(f"{n}:{len(tk)}" for n, tk in universes.items())
+        print(f"[cfg] universes {desc}")
+    else:
+        print(f"[cfg] tickers={len(tickers)}")
+    manifest = None
+    if args.sync:
+        manifest = Manifest(outdir / "_manifest.sqlite")
+        todo = []
+        for ds in dates:
+            why = sync_reason(
+                manifest,
+                s3,
+                ds,
+                targets_for(ds),
+                args.cols,
+                args.check_etag,
+                compact,
+                args.dataset,
+                args.verify,
+            )
+            if why != "OK":
+                todo.append(ds)
+                if why != "NEW":
+                    print(f"[{ds}] redo ({why})")
+        print(f"[sync] {len(dates) - len(todo)} of {len(dates)} days up to date")
+        dates = todo
+
+    print(
+        f"[cfg] days={len(dates)} outdir={outdir}"
+        f" stream={args.stream} engine={args.engine}"
+        f" compact={args.compact} hive={args.hive} dataset={args.dataset}"
+    )
+    t0 = time.perf_counter()
+    statuses = []
+    if args.pipeline:
+        from flatfile_pipeline import run_pipeline
+
+        statuses = run_pipeline(
+            s3,
+            dates,
+            targets_for,
+            spool_dir=outdir / "_spool",
+            keep_cols=args.cols,
+            engine=args.engine,
+            chunk_rows=args.chunk_rows,
+            buf_bytes=int(args.buf_mb * (1 << 20)),
+            block_bytes=int(args.block_mb * (1 << 20)),
+            cache=cache,
+            offline=args.offline,
+            manifest=manifest,
+            n_download=max(1, args.dl_workers),
+            n_parse=args.parse_workers,
+            queue_size=args.queue,
+            compact=compact,
+            dataset=args.dataset,
+            on_status=lambda ds, st: print(f"[{ds}] {st}"),
+        )
+    else:
+        # Parallel across days (keeps memory low and S3-friendly)
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+            futs = {
+                ex.submit(
+                    fetch_day_targets,
+                    s3,
+                    ds,
+                    targets_for(ds),
+                    keep_cols=args.cols,
+                    stream=args.stream,
+                    chunk_rows=args.chunk_rows,
+                    buf_bytes=int(args.buf_mb * (1 << 20)),
+                    engine=args.engine,
+                    block_bytes=int(args.block_mb * (1 << 20)),
+                    cache=cache,
+                    offline=args.offline,
+                    manifest=manifest,
+                    compact=compact,
+                    dataset=args.dataset,
+                ): ds
+                for ds in dates
+            }
+            for fut in as_completed(futs):
+                ds, st = fut.result()
+                statuses.append((ds, st))
+                print(f"[{ds}] {st}")
 
     # Quick summary
     ok = sum(st.startswith("OK") for _, st in statuses)
     miss = sum(st == "MISSING" for _, st in statuses)
     empty = sum(st == "EMPTY" for _, st in statuses)
+    uncached = sum(st == "UNCACHED" for _, st in statuses)
     err = [x for x in statuses if x[1].startswith("ERROR")]
-    print(f"[done] OK={ok} EMPTY={empty} MISSING={miss} ERR={len(err)}")
+    print(
+        f"[done] OK={ok} EMPTY={empty} MISSING={miss} ERR={len(err)}"
+        + (f" UNCACHED={uncached}" if uncached else "")
+        + f" wall={time.perf_counter() - t0:.1f}s"
+    )
     if err:
         print("Sample error:", err[0])
 
@@ -0,0 +1,199 @@
+# src/flatfile_cache.py
+"""On-disk cache of raw Polygon flatfile objects (.csv.gz).
+
+Blobs are content-addressed by (bucket, key, ETag) and tracked in a small
+SQLite index with their size and last access time. When the total size goes
+over ``max_bytes`` the least recently used blobs are evicted.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+from sqlite_util import transaction
+
+DDL = """
+CREATE TABLE IF NOT EXISTS objects(
+  bucket TEXT, key TEXT, etag TEXT,
+  path TEXT, size INT, last_access REAL,
+  PRIMARY KEY (bucket, key, etag)
+);
+"""
+
+
+class NotCached(KeyError):
+    """Raised in offline mode when an object is not in the cache."""
+
+
+def _norm_etag(etag: str | None) -> str:
+    return (etag or "").strip('"')
+
+
+def head_etag(s3, bucket: str, key: str) -> str:
+    """Current ETag of an object (unquoted); missing keys raise NoSuchKey."""
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        # HEAD reports a missing key as a bare 404; surface it like GET does
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        if code in ("404", "NoSuchKey"):
+            raise s3.exceptions.NoSuchKey(
+                {"Error": {"Code": "NoSuchKey", "Message": key}}, "HeadObject"
+            ) from e
+        raise
+    return _norm_etag(head.get("ETag"))
+
+
+class FlatfileCache:
+    def __init__(self, root: Path, max_bytes: int | None = None):
+        self.root = Path(root).expanduser()
+        self.max_bytes = max_bytes
+        self.db = self.root / "index.sqlite"
+        self._lock = threading.RLock()
+        (self.root / "objects").mkdir(parents=True, exist_ok=True)
+        with transaction(self.db) as conn:
+            conn.execute(DDL)
+
+    def blob_path(self, bucket: str, key: str, etag: str) -> Path:
+        h = hashlib.sha256(f"{bucket}/{key}@{etag}".encode()).hexdigest()
+        return self.root / "objects" / h[:2] / f"{h}.csv.gz"
+
+    # --------- lookups ---------
+    def lookup(self, bucket: str, key: str, etag: str | None = None) -> Path | None:
+        """Path of a cached blob, or None. etag=None -> most recent entry."""
+        hit = self._lookup(bucket, key, etag)
+        return hit[0] if hit else None
+
+    def _lookup(self, bucket, key, etag=None) -> tuple[Path, str] | None:
+        sql = "SELECT etag, path FROM objects WHERE bucket=? AND key=?"
+        params: tuple = (bucket, key)
+        if etag is not None:
+            sql += " AND etag=?"
+            params += (_norm_etag(etag),)
+        sql += " ORDER BY last_access DESC LIMIT 1"
+        with self._lock, transaction(self.db) as conn:
+            row = conn.execute(sql, params).fetchone()
+            if row is None:
+                return None
+            path = Path(row[1])
+            if not path.exists():
+                # blob deleted behind our back; forget it
+                conn.execute(
+                    "DELETE FROM objects WHERE bucket=? AND key=? AND etag=?",
+                    (bucket, key, row[0]),
+                )
+                return None
+            conn.execute(
+                "UPDATE objects SET last_access=? WHERE bucket=? AND key=? AND etag=?",
+                (time.time(), bucket, key, row[0]),
+            )
+        return path, row[0]
+
+    def put(self, bucket: str, key: str, etag: str, body, buf_bytes=1 << 20) -> Path:
+        """Stream ``body`` (anything with .read(n)) into the cache atomically."""
+        etag = _norm_etag(etag)
+        dst, size = self._download(bucket, key, etag, body, buf_bytes)
+        self._register(bucket, key, etag, dst, size)
+        return dst
+
+    def _download(self, bucket, key, etag, body, buf_bytes) -> tuple[Path, int]:
+        dst = self.blob_path(bucket, key, etag)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        size = 0
+        try:
+            with open(tmp, "wb") as fh:
+                while True:
+                    buf = body.read(buf_bytes)
+                    if not buf:
+                        break
+                    fh.write(buf)
+                    size += len(buf)
+            os.replace(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return dst, size
+
+    def _register(self, bucket, key, etag, dst: Path, size: int):
+        with self._lock, transaction(self.db) as conn:
+            # a new ETag supersedes older versions of the same key
+            stale = conn.execute(
+                "SELECT path FROM objects WHERE bucket=? AND key=? AND etag<>?",
+                (bucket, key, etag),
+            ).fetchall()
+            for (p,) in stale:
+                Path(p).unlink(missing_ok=True)
+            conn.execute(
+                "DELETE FROM objects WHERE bucket=? AND key=? AND etag<>?",
+                (bucket, key, etag),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?,?)",
+                (bucket, key, etag, str(dst), size, time.time()),
+            )
+            self._evict(conn, keep=str(dst))
+
+    def _evict(self, conn, keep: str | None = None):
+        if not self.max_bytes:
+            return
+        (total,) = conn.execute("SELECT COALESCE(SUM(size),0) FROM objects").fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT bucket, key, etag, path, size FROM objects ORDER BY last_access ASC"
+        ).fetchall()
+        for bucket, key, etag, path, size in rows:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            Path(path).unlink(missing_ok=True)
+            conn.execute(
+                "DELETE FROM objects WHERE bucket=? AND key=? AND etag=?",
+                (bucket, key, etag),
+            )
+            total -= size
+
+    def stats(self) -> tuple[int, int]:
+        """(n_objects, total_bytes)."""
+        with transaction(self.db) as conn:
+            n, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size),0) FROM objects"
+            ).fetchone()
+        return n, total
+
+    # --------- fetch ---------
+    def open(self, s3, bucket: str, key: str, offline=False, buf_bytes=1 << 20):
+        """(binary file handle, etag) for the raw object, served from cache when fresh.
+
+        Online: HEAD the object and reuse the blob if its ETag is cached,
+        otherwise download it into the cache first. Offline: never touch S3;
+        raise NotCached if nothing is cached for (bucket, key).
+        """
+        # handles are opened under the lock so a concurrent eviction can only
+        # unlink the blob after we hold it open
+        if offline:
+            with self._lock:
+                hit = self._lookup(bucket, key)
+                if hit is None:
+                    raise NotCached(f"{bucket}/{key}")
+                return open(hit[0], "rb"), hit[1]
+
+        etag = head_etag(s3, bucket, key)
+        with self._lock:
+            hit = self._lookup(bucket, key, etag)
+            if hit is not None:
+                return open(hit[0], "rb"), hit[1]
+
+        obj = s3.get_object(Bucket=bucket, Key=key)
+        # cache under the ETag of what we actually downloaded
+        etag = _norm_etag(obj.get("ETag"))
+        try:
+            dst, size = self._download(bucket, key, etag, obj["Body"], buf_bytes)
+        finally:
+            obj["Body"].close()
+        with self._lock:
+            self._register(bucket, key, etag, dst, size)
+            return open(dst, "rb"), etag
@@ -0,0 +1,347 @@
+# src/flatfile_pipeline.py
+"""Pipelined executor for poly-fetch: download -> parse -> write.
+
+- download (threads): pull each day's raw .csv.gz into a local spool file
+  (hard-linked from the flatfile cache when one is used).
+- parse (processes): gunzip + parse + filter into uncompressed Arrow IPC
+  files next to the spool, outside the parent's GIL.
+- write (one thread): Parquet-encode each target's IPC file into its
+  ``.tmp`` (sorting it first with --compact), rename into place, update the
+  manifest, drop the spool.
+
+Stages are joined by bounded queues, so a slow stage back-pressures the ones
+before it. Each stage keeps a StageStats; the summary's busy% (busy time over
+wall time x workers) shows which stage is the bottleneck.
+
+If the parse pool dies (a worker killed by the OOM killer, say) the days not
+yet parsed are reported as errors and the download threads stop.
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fetch_polygon_flatfiles import (
+    commit_targets,
+    open_day,
+    parse_to_tmp,
+    tmp_path,
+    write_compact,
+)
+from flatfile_cache import NotCached
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.wait = 0.0  # time blocked on a full downstream queue / free slot
+        self._lock = threading.Lock()
+
+    def add(self, secs: float, nbytes: int = 0, wait: float = 0.0):
+        with self._lock:
+            self.items += 1
+            self.bytes += nbytes
+            self.busy += secs
+            self.wait += wait
+
+    def line(self, wall: float) -> str:
+        wall = max(wall, 1e-9)
+        util = self.busy / (wall * max(1, self.workers))
+        return (
+            f"[pipe] {self.name:<8} workers={self.workers:<3} items={self.items:<5}"
+            f" MB={self.bytes / 1e6:,.0f} MB/s={self.bytes / 1e6 / wall:,.1f}"
+            f" busy={util:.0%} blocked={self.wait:.1f}s"
+        )
+
+
+def spool_day(
+    s3, date_str, spool_dir: Path, buf_bytes, cache, offline, dataset="stocks"
+):
+    """(spool path, etag, compressed bytes) for one day's raw object."""
+    body, etag = open_day(s3, date_str, True, buf_bytes, cache, offline, dataset)
+    spool = spool_dir / f"{date_str}.csv.gz"
+    spool.unlink(missing_ok=True)
+    with body:
+        name = getattr(body, "name", None)
+        if cache is not None and isinstance(name, str):
+            # cached blob: a hard link survives a concurrent eviction
+            try:
+                os.link(name, spool)
+                return spool, etag, spool.stat().st_size
+            except OSError:
+                pass
+        try:
+            with open(spool, "wb") as fh:
+                shutil.copyfileobj(body, fh, buf_bytes)
+        except Exception:
+            spool.unlink(missing_ok=True)
+            raise
+    return spool, etag, spool.stat().st_size
+
+
+def parse_day(
+    spool: Path,
+    targets,
+    keep_cols,
+    engine,
+    chunk_rows,
+    block_bytes,
+    dataset="stocks",
+    date_str=None,
+):
+    """Process-pool entry point: parse one spooled day into Arrow IPC files.
+
+    Returns ({name: (rows, ipc path or None)}, seconds).
+    """
+    t0 = time.perf_counter()
+    runs = {
+        name: (tk, spool.with_name(f"{spool.name}.{name}.arrows"))
+        for name, (tk, _) in targets.items()
+    }
+    with open(spool, "rb") as body:
+        written = parse_to_tmp(
+            body,
+            runs,
+            keep_cols,
+            engine,
+            chunk_rows,
+            block_bytes,
+            None,
+            dataset,
+            date_str,
+            ipc=True,
+        )
+    out = {}
+    for name, (rows, _) in written.items():
+        run = runs[name][1]
+        if rows:
+            os.replace(tmp_path(run), run)
+        out[name] = (rows, run if rows else None)
+    return out, time.perf_counter() - t0
+
+
+def encode_day(runs, targets, compact=None) -> dict[str, tuple[int, str | None]]:
+    """Write stage: encode each target's IPC file into its Parquet ``.tmp``.
+
+    Returns {name: (rows, schema string)} as parse_to_tmp does; on error the
+    temp files are removed and the exception propagates.
+    """
+    written = {}
+    try:
+        for name, (_, out) in targets.items():
+            rows, run = runs[name]
+            if run is None:
+                written[name] = (0, None)
+                continue
+            out.parent.mkdir(parents=True, exist_ok=True)
+            with pa.memory_map(str(run)) as src:
+                reader = pa.ipc.open_stream(src)
+                if compact:
+                    # memory-mapped, so only the sort order and a row group
+                    # at a time are resident
+                    schema = write_compact(reader.read_all(), tmp_path(out), compact)
+                else:
+                    with pq.ParquetWriter(
+                        tmp_path(out), reader.schema, compression="zstd"
+                    ) as w:
+                        for batch in reader:
+                            w.write_batch(batch)
+                    schema = reader.schema.to_string()
+            written[name] = (rows, schema)
+    except Exception:
+        for _, out in targets.values():
+            tmp_path(out).unlink(missing_ok=True)
+        raise
+    return written
+
+
+def run_pipeline(
+    s3,
+    dates: list[str],
+    targets_for,
+    spool_dir: Path,
+    keep_cols=None,
+    engine: str = "arrow",
+    chunk_rows: int = 200_000,
+    buf_bytes: int = 1 << 20,
+    block_bytes: int = 16 << 20,
+    cache=None,
+    offline: bool = False,
+    manifest=None,
+    n_download: int = 4,
+    n_parse: int | None = None,
+    queue_size: int | None = None,
+    compact: dict | None = None,
+    dataset: str = "stocks",
+    on_status=None,
+) -> list[tuple[str, str]]:
+    """Run the three stages over ``dates``; returns [(date, status)].
+
+    ``targets_for(date)`` gives the {name: (tickers, out path)} for a day, as in
+    fetch_day_targets. ``queue_size`` bounds both the spooled-but-unparsed days
+    and the days in flight in the parse pool (default 2 x n_parse).
+    """
+    n_parse = n_parse or os.cpu_count() or 1
+    queue_size = queue_size or 2 * n_parse
+    spool_dir.mkdir(parents=True, exist_ok=True)
+
+    st_dl = StageStats("download", n_download)
+    st_parse = StageStats("parse", n_parse)
+    st_write = StageStats("write", 1)
+
+    q_dates: queue.Queue = queue.Queue()
+    for ds in dates:
+        q_dates.put(ds)
+    q_raw: queue.Queue = queue.Queue(maxsize=queue_size)
+    q_write: queue.Queue = queue.Queue()
+    slots = threading.BoundedSemaphore(queue_size)
+    statuses: list[tuple[str, str]] = []
+
+    def downloader():
+        while True:
+            try:
+                ds = q_dates.get_nowait()
+            except queue.Empty:
+                break
+            t0 = time.perf_counter()
+            try:
+                spool, etag, nbytes = spool_day(
+                    s3, ds, spool_dir, buf_bytes, cache, offline, dataset
+                )
+                item = (ds, spool, etag)
+            except NotCached:
+                item, nbytes = (ds, "UNCACHED"), 0
+            except s3.exceptions.NoSuchKey:  # type: ignore[attr-defined]
+                item, nbytes = (ds, "MISSING"), 0
+            except Exception as e:
+                item, nbytes = (ds, f"ERROR:{e}"), 0
+            t1 = time.perf_counter()
+            q_raw.put(item)  # blocks while the parse stage is behind
+            st_dl.add(t1 - t0, nbytes, wait=time.perf_counter() - t1)
+        q_raw.put(_DONE)
+
+    def writer():
+        while True:
+            item = q_write.get()
+            if item is _DONE:
+                break
+            t0 = time.perf_counter()
+            if len(item) == 2:
+                ds, st = item
+            else:
+                ds, spool, etag, fut = item
+                runs, nbytes = {}, 0
+                try:
+                    runs, secs = fut.result()
+                    st_parse.add(secs, spool.stat().st_size)
+                    nbytes = sum(r.stat().st_size for _, r in runs.values() if r)
+                    targets = targets_for(ds)
+                    written = encode_day(runs, targets, compact)
+                    _, st = commit_targets(
+                        ds,
+                        targets,
+                        written,
+                        etag,
+                        keep_cols,
+                        manifest,
+                        compact,
+                        dataset,
+                    )
+                except Exception as e:
+                    st = f"ERROR:{e}"
+                finally:
+                    spool.unlink(missing_ok=True)
+                    for _, run in runs.values():
+                        if run is not None:
+                            run.unlink(missing_ok=True)
+                    slots.release()
+                st_write.add(time.perf_counter() - t0, nbytes)
+            statuses.append((ds, st))
+            if on_status is not None:
+                on_status(ds, st)
+
+    t_start = time.perf_counter()
+    dl_threads = [
+        threading.Thread(target=downloader, daemon=True) for _ in range(n_download)
+    ]
+    wr_thread = threading.Thread(target=writer, daemon=True)
+    for t in dl_threads:
+        t.start()
+    wr_thread.start()
+
+    ctx = mp.get_context("spawn")  # don't fork a process that is running threads
+    broken: BrokenProcessPool | None = None
+    with ProcessPoolExecutor(max_workers=n_parse, mp_context=ctx) as pool:
+        done = 0
+        while done < n_download:
+            item = q_raw.get()
+            if item is _DONE:
+                done += 1
+                continue
+            if len(item) == 2:
+                q_write.put(item)
+                continue
+            ds, spool, etag = item
+            if broken is not None:
+                # keep draining so blocked downloaders can finish and exit
+                spool.unlink(missing_ok=True)
+                q_write.put((ds, f"ERROR:{broken}"))
+                continue
+            slots.acquire()  # bound the days in flight in the pool
+            try:
+                fut = pool.submit(
+                    parse_day,
+                    spool,
+                    targets_for(ds),
+                    keep_cols,
+                    engine,
+                    chunk_rows,
+                    block_bytes,
+                    dataset,
+                    ds,
+                )
+            except BrokenProcessPool as e:
+                broken = e
+                slots.release()
+                spool.unlink(missing_ok=True)
+                q_write.put((ds, f"ERROR:{e}"))
+                # cancel the days no downloader has picked up yet
+                while True:
+                    try:
+                        q_write.put((q_dates.get_nowait(), f"ERROR:{e}"))
+                    except queue.Empty:
+                        break
+                continue
+            fut.add_done_callback(
+                lambda f, ds=ds, spool=spool, etag=etag: q_write.put(
+                    (ds, spool, etag, f)
+                )
+            )
+    q_write.put(_DONE)
+    wr_thread.join()
+    for t in dl_threads:
+        t.join()
+
+    wall = time.perf_counter() - t_start
+    for st in (st_dl, st_parse, st_write):
+        print(st.line(wall))
+    try:
+        spool_dir.rmdir()
+    except OSError:
+        pass
+    return statuses
@@ -0,0 +1,148 @@
+# src/ivol_cache.py
+"""Superset cache of raw IVol stock-opts-by-param responses.
+
+Each API response is kept as a Parquet file together with what it covers:
+(symbol, cp, c_date range) and the DTE / delta band it was requested with.
+A later request whose band lies inside a cached band is answered by
+filtering those rows locally; only the dates no superset covers go to the API.
+"""
+
+import os
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from manifest import fingerprint
+from sqlite_util import transaction
+
+DDL = """
+CREATE TABLE IF NOT EXISTS coverage(
+  id INTEGER PRIMARY KEY,
+  symbol TEXT, cp TEXT, start_date TEXT, end_date TEXT,
+  dte_lo INT, dte_hi INT, delta_lo REAL, delta_hi REAL,
+  path TEXT, nrows INT,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS coverage_key ON coverage(symbol, cp, start_date);
+"""
+
+# columns needed to re-apply the API's filters locally
+FILTER_COLS = ("c_date", "dte", "delta")
+
+
+def _day(s: str) -> date:
+    return date.fromisoformat(str(s)[:10])
+
+
+def date_gaps(start, end, covered) -> list[tuple[str, str]]:
+    """Sub-ranges of [start, end] (ISO dates, inclusive) not in ``covered``."""
+    lo, hi = _day(start), _day(end)
+    gaps, cur = [], lo
+    for s, e in sorted((_day(s), _day(e)) for s, e in covered):
+        if s > cur:
+            gaps.append((cur, min(hi, s - timedelta(days=1))))
+        cur = max(cur, e + timedelta(days=1))
+        if cur > hi:
+            break
+    if cur <= hi:
+        gaps.append((cur, hi))
+    return [(s.isoformat(), e.isoformat()) for s, e in gaps if s <= e]
+
+
+class ResponseCache:
+    def __init__(self, root: Path):
+        self.root = Path(root).expanduser()
+        self.db = self.root / "index.sqlite"
+        self._lock = threading.Lock()
+        self.local = self.partial = self.remote = 0
+        (self.root / "objects").mkdir(parents=True, exist_ok=True)
+        with transaction(self.db) as conn:
+            conn.executescript(DDL)
+
+    def _supersets(self, symbol, cp, start, end, dte, band):
+        """Cached responses overlapping [start, end] whose band contains ours."""
+        with transaction(self.db) as conn:
+            return conn.execute(
+                "SELECT start_date, end_date, path FROM coverage"
+                " WHERE symbol=? AND cp=? AND start_date<=? AND end_date>=?"
+                " AND dte_lo<=? AND dte_hi>=? AND delta_lo<=? AND delta_hi>=?"
+                " ORDER BY start_date",
+                (symbol, cp, end, start, dte[0], dte[1], band[0], band[1]),
+            ).fetchall()
+
+    def lookup(self, symbol, cp, start, end, dte, band):
+        """(locally filtered rows or None, [(gap_start, gap_end), ...]).
+
+        ``band`` is the signed delta band sent to the API (puts negative).
+        Rows from overlapping supersets may repeat; callers dedup.
+        """
+        lo, hi = _day(start), _day(end)
+        frames, covered = [], []
+        for s, e, path in self._supersets(symbol, cp, start, end, dte, band):
+            s, e = max(_day(s), lo), min(_day(e), hi)
+            covered.append((s, e))
+            if path is None:
+                continue  # the API had nothing for this window
+            df = pd.read_parquet(path)
+            day = df["c_date"].astype(str).str[:10]
+            mask = (
+                day.between(s.isoformat(), e.isoformat())
+                & df["dte"].between(dte[0], dte[1])
+                & df["delta"].between(band[0], band[1])
+            )
+            if mask.any():
+                frames.append(df[mask])
+
+        gaps = date_gaps(start, end, covered)
+
+        with self._lock:
+            if not gaps:
+                self.local += 1
+            elif covered:
+                self.partial += 1
+            else:
+                self.remote += 1
+        out = pd.concat(frames, ignore_index=True) if frames else None
+        return out, gaps
+
+    def put(self, symbol, cp, start, end, dte, band, df):
+        """Remember one API response for (symbol, cp, [start, end], band)."""
+        path = None
+        if df is not None and len(df) > 0:
+            if not all(c in df.columns for c in FILTER_COLS):
+                return  # could not be filtered locally later
+            key = fingerprint([symbol, cp, start, end, dte, band])
+            dst = self.root / "objects" / symbol / f"{cp}_{start}_{end}_{key}.parquet"
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                df.to_parquet(tmp, index=False)
+                os.replace(tmp, dst)
+            finally:
+                tmp.unlink(missing_ok=True)
+            path = str(dst)
+        with self._lock, transaction(self.db) as conn:
+            conn.execute(
+                "INSERT INTO coverage(symbol,cp,start_date,end_date,dte_lo,dte_hi,"
+                "delta_lo,delta_hi,path,nrows) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (
+                    symbol,
+                    cp,
+                    start,
+                    end,
+                    dte[0],
+                    dte[1],
+                    band[0],
+                    band[1],
+                    path,
+                    0 if df is None else len(df),
+                ),
+            )
+
+    def summary(self) -> str:
+        return (
+            f"[cache] units local={self.local} partial={self.partial}"
+            f" remote={self.remote}"
+        )
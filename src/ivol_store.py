@@ -0,0 +1,204 @@
+# src/ivol_store.py
+"""Primary-key deduplicated store of raw IVol option rows.
+
+Rows live in ``<root>/year=YYYY/symbol=SYM/data.parquet`` (year of c_date).
+Every write is a merge: the partition is read, the new rows are appended,
+duplicates on KEY_COLS are dropped (the newest pull wins) and the file is
+replaced atomically. However many pulls overlap, each quote is stored once.
+
+Files use the compact schema of ``compact_table``: DATE dates, dictionary
+call_put, int64 ids/counts, float64 prices and greeks, rows sorted by
+SORT_COLS so row-group stats prune on c_date / expiration_date.
+
+Single writer per store: merges are serialized inside one process only.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# (c_date, option_symbol/stocks_id, expiration_date, price_strike, call_put);
+# whichever of these the provider returned form the key
+KEY_COLS = [
+    "c_date",
+    "option_symbol",
+    "stocks_id",
+    "expiration_date",
+    "price_strike",
+    "call_put",
+]
+SORT_COLS = ["c_date", "expiration_date", "price_strike", "call_put"]
+DATE_COLS = {"c_date", "expiration_date"}
+INT_COLS = {"stocks_id", "dte", "volume", "openinterest", "open_interest"}
+DICT_COLS = {"call_put"}
+TEXT_COLS = {"option_symbol", "symbol", "call_put"}
+ROW_GROUP_ROWS = 128_000
+
+
+def key_cols(columns) -> list[str]:
+    return [k for k in KEY_COLS if k in columns]
+
+
+def compact_type(name: str, typ: pa.DataType) -> pa.DataType:
+    """Target type of a raw IVol column (case-insensitive on the name)."""
+    name = name.lower()
+    if name in DATE_COLS:
+        return pa.date32()
+    if name in DICT_COLS:
+        return pa.string()  # dictionary-encoded after sorting
+    if name in INT_COLS and (pa.types.is_integer(typ) or pa.types.is_floating(typ)):
+        return pa.int64()
+    if pa.types.is_integer(typ) or pa.types.is_floating(typ):
+        return pa.float64()
+    if pa.types.is_null(typ):
+        # all-null chunk: text columns stay text, the rest are greeks/prices
+        return pa.string() if name in TEXT_COLS else pa.float64()
+    return typ
+
+
+def compact_table(table: pa.Table, sort: bool = True) -> pa.Table:
+    """Cast to the compact IVol schema, sort by SORT_COLS, encode call_put."""
+    table = table.replace_schema_metadata(None)
+    for i, f in enumerate(table.schema):
+        if pa.types.is_dictionary(f.type):
+            table = table.set_column(i, f.name, table.column(i).cast(f.type.value_type))
+    schema = pa.schema(
+        [f.with_type(compact_type(f.name, f.type)) for f in table.schema]
+    )
+    table = table.cast(schema)
+    if sort:
+        keys = [c for c in SORT_COLS if c in table.column_names]
+        if keys:
+            table = table.sort_by([(c, "ascending") for c in keys])
+    for c in DICT_COLS & set(table.column_names):
+        i = table.column_names.index(c)
+        table = table.set_column(
+            i, c, table.column(c).cast(pa.dictionary(pa.int8(), pa.string()))
+        )
+    return table
+
+
+class RawStore:
+    def __init__(self, root: Path):
+        self.root = Path(root).expanduser()
+        self._lock = threading.Lock()
+
+    def part_path(self, year: int, symbol: str) -> Path:
+        return self.root / f"year={year}" / f"symbol={symbol}" / "data.parquet"
+
+    def merge(self, df: pd.DataFrame, symbol: str) -> tuple[int, int]:
+        """Merge ``df`` (one symbol's rows) in; returns (new rows, duplicates)."""
+        if df is None or len(df) == 0:
+            return 0, 0
+        keys = key_cols(df.columns)
+        if "c_date" not in keys:
+            raise ValueError("rows need a c_date column to be stored")
+        df = df.drop(columns=["symbol"], errors="ignore")
+        # same types as the stored rows, so keys compare equal
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        df = compact_table(table, sort=False).to_pandas()
+        years = pd.to_datetime(df["c_date"]).dt.year
+        inserted = dupes = 0
+        with self._lock:
+            for year, part in df.groupby(years.values):
+                n_new, n_dup = self._merge_part(int(year), symbol, part, keys)
+                inserted += n_new
+                dupes += n_dup
+        return inserted, dupes
+
+    def _merge_part(self, year, symbol, part, keys):
+        path = self.part_path(year, symbol)
+        old = pd.read_parquet(path) if path.exists() else None
+        n_old = 0 if old is None else len(old)
+        both = part if old is None else pd.concat([old, part], ignore_index=True)
+        merged = both.drop_duplicates(subset=keys, keep="last")
+        table = compact_table(pa.Table.from_pandas(merged, preserve_index=False))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            pq.write_table(
+                table, tmp, row_group_size=ROW_GROUP_ROWS, compression="zstd"
+            )
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        inserted = len(merged) - n_old
+        return inserted, len(part) - inserted
+
+    def merge_file(self, path, symbol: str, batch_rows: int = 1_000_000):
+        """Merge a per-symbol output file without loading it whole.
+
+        Batches are first spooled per year, then each year's rows are merged
+        in one go, so every year=/symbol= partition is rewritten once.
+        """
+        path = str(path)
+        if path.endswith(".csv"):
+            batches = pd.read_csv(path, chunksize=batch_rows)
+        else:
+            pf = pq.ParquetFile(path)
+            batches = (b.to_pandas() for b in pf.iter_batches(batch_size=batch_rows))
+        # next to the store, not in it: readers glob <root>/*/*/*.parquet
+        self.root.parent.mkdir(parents=True, exist_ok=True)
+        spool = Path(tempfile.mkdtemp(prefix=f".spool-{symbol}-", dir=self.root.parent))
+        inserted = dupes = 0
+        try:
+            spooled: dict[int, list[Path]] = {}
+            for i, df in enumerate(batches):
+                if "c_date" not in df.columns:
+                    raise ValueError("rows need a c_date column to be stored")
+                years = pd.to_datetime(df["c_date"]).dt.year
+                for year, part in df.groupby(years.values):
+                    f = spool / f"{int(year)}_{i:05d}.parquet"
+                    part.to_parquet(f, index=False)
+                    spooled.setdefault(int(year), []).append(f)
+            for year, files in sorted(spooled.items()):
+                # batch order is kept, so a later row still wins a duplicate key
+                df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+                n_new, n_dup = self.merge(df, symbol)
+                inserted += n_new
+                dupes += n_dup
+        finally:
+            shutil.rmtree(spool, ignore_errors=True)
+        return inserted, dupes
+
+
+def symbol_from_name(path) -> str | None:
+    """SYM from an ``ivol_SYM_<tag>`` file written by fetch_ivol_by_list."""
+    m = re.match(r"ivol_(.+?)_\d{4}-\d{2}-\d{2}_", Path(path).name)
+    return m.group(1) if m and m.group(1) != "ALL" else None
+
+
+def main():
+    from paths import DATA_DIR
+
+    p = argparse.ArgumentParser(
+        description="Merge per-symbol IVol pulls into the deduplicated raw store."
+    )
+    p.add_argument("files", nargs="+", help="ivol_<SYM>_*.parquet/.csv files")
+    p.add_argument(
+        "--store",
+        default=None,
+        help="Store root (default: ${IVOL_DATA_DIR}/store/ivol).",
+    )
+    args = p.parse_args()
+
+    store = RawStore(Path(args.store) if args.store else DATA_DIR / "store/ivol")
+    for f in args.files:
+        sym = symbol_from_name(f)
+        if sym is None:
+            print(f"[SKIP] {f}: no symbol in file name")
+            continue
+        inserted, dupes = store.merge_file(f, sym)
+        print(f"[OK] {sym}: +{inserted:,} rows, {dupes:,} duplicates dropped <- {f}")
+
+
+if __name__ == "__main__":
+    main()
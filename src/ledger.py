@@ -1,7 +1,7 @@
 # src/ledger.py
 import sqlite3
 import json
-from .paths import DATA_DIR
+from paths import DATA_DIR
 
 DB = DATA_DIR / "loader_ledger.sqlite"
 
@@ -15,22 +15,36 @@ CREATE TABLE IF NOT EXISTS ingestions(
 );
 """
 
+# columns added after the first release; ALTERed into older ledgers
+MIGRATIONS = {"cp": "ALTER TABLE ingestions ADD COLUMN cp TEXT"}
+
+INDEX = """
+CREATE INDEX IF NOT EXISTS ingestions_unit
+  ON ingestions(symbol, cp, start_date, end_date, dte_lo, dte_hi, abs_lo, abs_hi);
+"""
+
 
 def connect():
     DB.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB)
+    conn = sqlite3.connect(DB, timeout=30)
     conn.execute(DDL)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(ingestions)")}
+    for col, sql in MIGRATIONS.items():
+        if col not in cols:
+            conn.execute(sql)
+    conn.execute(INDEX)
     conn.commit()
     return conn
 
 
-def record(symbol, start, end, dte, delta, nrows, bytes_, status, extra=None):
+def record(symbol, start, end, dte, delta, nrows, bytes_, status, extra=None, cp=None):
     conn = connect()
     conn.execute(
-        "INSERT INTO ingestions(symbol,start_date,end_date,dte_lo,dte_hi,abs_lo,abs_hi,nrows,bytes,status,params)"
-        " VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+        "INSERT INTO ingestions(symbol,cp,start_date,end_date,dte_lo,dte_hi,abs_lo,abs_hi,nrows,bytes,status,params)"
+        " VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
         (
             symbol,
+            cp,
             start,
             end,
             dte[0],
@@ -45,3 +59,48 @@ def record(symbol, start, end, dte, delta, nrows, bytes_, status, extra=None):
     )
     conn.commit()
     conn.close()
+
+
+def unit_status(symbol, dte, delta, out=None):
+    """Latest status per (cp, start, end) unit of ``symbol`` for a filter band.
+
+    ``out`` restricts to units recorded against that output file.
+    """
+    sql = (
+        "SELECT cp, start_date, end_date, status FROM ingestions"
+        " WHERE symbol=? AND dte_lo=? AND dte_hi=? AND abs_lo=? AND abs_hi=?"
+    )
+    params = [symbol, dte[0], dte[1], delta[0], delta[1]]
+    if out is not None:
+        sql += " AND json_extract(params, '$.out')=?"
+        params.append(str(out))
+    conn = connect()
+    rows = conn.execute(sql + " ORDER BY id", params).fetchall()
+    conn.close()
+    return {(cp, s, e): st for cp, s, e, st in rows}
+
+
+def supersede(out):
+    """Retire done units recorded against ``out`` before it is rewritten."""
+    conn = connect()
+    conn.execute(
+        "UPDATE ingestions SET status='SUPERSEDED'"
+        " WHERE json_extract(params, '$.out')=? AND status IN ('OK','EMPTY')",
+        (str(out),),
+    )
+    conn.commit()
+    conn.close()
+
+
+def density(symbol, cp, dte, delta):
+    """(rows, calendar days) over past units of ``symbol``/``cp`` for a band."""
+    conn = connect()
+    rows, days = conn.execute(
+        "SELECT COALESCE(SUM(nrows),0),"
+        " COALESCE(SUM(julianday(end_date)-julianday(start_date)+1),0)"
+        " FROM ingestions WHERE symbol=? AND cp=? AND dte_lo=? AND dte_hi=?"
+        " AND abs_lo=? AND abs_hi=? AND status IN ('OK','EMPTY','SUPERSEDED')",
+        (symbol, cp, dte[0], dte[1], delta[0], delta[1]),
+    ).fetchone()
+    conn.close()
+    return int(rows), int(days)
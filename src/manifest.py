@@ -0,0 +1,137 @@
+# src/manifest.py
+"""SQLite manifest of derived output files, one row per partition.
+
+Each row records what an output was built from (``source``: ETag, input
+hash, ...), with which parameters (``params``), and what was written
+(row count, schema, sha256). ``check`` tells a re-run whether the
+partition can be skipped or must be rebuilt.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from sqlite_util import transaction
+
+DDL = """
+CREATE TABLE IF NOT EXISTS entries(
+  part TEXT PRIMARY KEY,
+  path TEXT, source TEXT, params TEXT,
+  nrows INT, schema TEXT, sha256 TEXT, status TEXT,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def file_sha256(path: Path, buf_bytes: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while True:
+            buf = fh.read(buf_bytes)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def fingerprint(obj) -> str:
+    """Short stable hash of any JSON-able parameter set."""
+    blob = json.dumps(obj, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()[:16]
+
+
+class Manifest:
+    def __init__(self, db: Path):
+        self.db = Path(db)
+        self._lock = threading.Lock()
+        self.db.parent.mkdir(parents=True, exist_ok=True)
+        with transaction(self.db) as conn:
+            conn.execute(DDL)
+
+    def get(self, part: str) -> dict | None:
+        with transaction(self.db) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM entries WHERE part=?", (part,)).fetchone()
+        return dict(row) if row else None
+
+    def parts(self) -> dict[str, dict]:
+        with transaction(self.db) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM entries").fetchall()
+        return {r["part"]: dict(r) for r in rows}
+
+    def record(
+        self,
+        part: str,
+        path: Path | None,
+        source: str | None,
+        params: str | None,
+        nrows: int,
+        schema: str | None = None,
+        status: str = "OK",
+    ):
+        """Upsert a partition; the sha256 of ``path`` is computed here."""
+        sha = file_sha256(path) if path is not None and nrows else None
+        with self._lock, transaction(self.db) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries"
+                "(part,path,source,params,nrows,schema,sha256,status)"
+                " VALUES (?,?,?,?,?,?,?,?)",
+                (
+                    part,
+                    str(path) if path is not None else None,
+                    source,
+                    params,
+                    nrows,
+                    schema,
+                    sha,
+                    status,
+                ),
+            )
+
+    def record_many(self, entries: list[dict]):
+        """Upsert several partitions in one transaction.
+
+        Each entry has the columns of ``entries``; its ``sha256`` is stored as
+        given, so many parts sharing one output file hash it only once.
+        """
+        cols = ("part", "path", "source", "params", "nrows", "schema", "sha256")
+        rows = [(*(e.get(c) for c in cols), e.get("status", "OK")) for e in entries]
+        with self._lock, transaction(self.db) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries"
+                "(part,path,source,params,nrows,schema,sha256,status)"
+                " VALUES (?,?,?,?,?,?,?,?)",
+                rows,
+            )
+
+    def forget(self, part: str):
+        with self._lock, transaction(self.db) as conn:
+            conn.execute("DELETE FROM entries WHERE part=?", (part,))
+
+    def check(
+        self, part: str, params: str | None = None, source=None, verify=True
+    ) -> str:
+        """'OK' if the partition can be skipped, else why it must be rebuilt.
+
+        Returns one of OK, NEW, PARAMS (built with other params), STALE
+        (source changed), LOST (file gone) or CORRUPT (checksum mismatch).
+        ``source=None`` skips the source comparison.
+        """
+        row = self.get(part)
+        if row is None:
+            return "NEW"
+        if params is not None and row["params"] != params:
+            return "PARAMS"
+        if source is not None and row["source"] != source:
+            return "STALE"
+        if row["status"] == "EMPTY":
+            return "OK"
+        path = Path(row["path"])
+        if not path.exists():
+            return "LOST"
+        if verify and file_sha256(path) != row["sha256"]:
+            return "CORRUPT"
+        return "OK"
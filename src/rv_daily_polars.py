@@ -1,107 +1,248 @@
 import math
+import os
 import sys
+from datetime import date, timedelta
+from functools import cache
+from pathlib import Path
+
+import pandas as pd
+import pandas_market_calendars as mcal
 import polars as pl
+import pyarrow.parquet as pq
 
 # sane range in MILLISECONDS: 2000-01-01 .. 2100-01-01
 MS_MIN = 946_684_800_000
 MS_MAX = 4_102_444_800_000
 
+# bump when rv_daily's output changes, so incremental runs recompute
+RV_VERSION = 1
 
-def rv_daily_for_file(path: str, ks=(1, 5, 15, 30)) -> pl.DataFrame:
-    ws = pl.col("window_start").cast(pl.Int64)
+EPOCH_DAY = date(1970, 1, 1)
+
+# ticks per second by magnitude of a plausible epoch value (sec/ms/µs/ns)
+EPOCH_UNITS = [
+    (10**9, 10**10, 1),
+    (10**12, 10**13, 1_000),
+    (10**15, 10**16, 1_000_000),
+    (10**18, 10**19, 1_000_000_000),
+]
+
+
+def epoch_unit(path: str) -> int:
+    """Ticks per second of ``window_start``, from Parquet stats or a sample."""
+    vals = []
+    md = pq.ParquetFile(path).metadata
+    i = md.schema.to_arrow_schema().get_field_index("window_start")
+    for rg in range(md.num_row_groups):
+        st = md.row_group(rg).column(i).statistics
+        if st is not None and st.has_min_max:
+            vals += [st.min, st.max]
+    if not vals:
+        vals = (
+            pl.scan_parquet(path)
+            .select(pl.col("window_start").cast(pl.Int64))
+            .head(1000)
+            .collect()["window_start"]
+            .to_list()
+        )
+    for v in vals:
+        for lo, hi, tps in EPOCH_UNITS:
+            if v is not None and lo <= v < hi and MS_MIN <= v * 1000 // tps <= MS_MAX:
+                return tps
+    raise ValueError(f"{path}: window_start is not a sec/ms/µs/ns epoch")
+
+
+@cache
+def nyse_year(year: int) -> pl.DataFrame:
+    """NYSE sessions of ``year``: trade_date, open and close in epoch ns."""
+    sched = mcal.get_calendar("NYSE").schedule(
+        start_date=f"{year}-01-01", end_date=f"{year}-12-31"
+    )
+
+    def ns(ts):
+        return ts.astype("datetime64[ns, UTC]").astype("int64").to_numpy()
 
-    # Normalize epoch to MILLISECONDS (handles sec/ms/µs/ns)
-    ws_ms = (
-        pl.when((ws >= 1_000_000_000) & (ws <= 9_999_999_999))  # seconds
-        .then(ws * 1_000)
-        .when((ws >= 1_000_000_000_000) & (ws <= 9_999_999_999_999))  # ms
-        .then(ws)
-        .when((ws >= 1_000_000_000_000_000) & (ws <= 9_999_999_999_999_999))  # µs
-        .then(ws // 1_000)
-        .when(
-            (ws >= 1_000_000_000_000_000_000) & (ws <= 9_999_999_999_999_999_999)
-        )  # ns
-        .then(ws // 1_000_000)
-        .otherwise(None)
-        .alias("ws_ms")
+    return pl.DataFrame(
+        {
+            "trade_date": pd.DatetimeIndex(sched.index).tz_localize(None).normalize(),
+            "open": ns(sched["market_open"]),
+            "close": ns(sched["market_close"]),
+        },
+        schema={"trade_date": pl.Date, "open": pl.Int64, "close": pl.Int64},
     )
 
-    lf = (
-        pl.scan_parquet(path)
+
+def sessions(start: date, end: date, tps: int) -> pl.DataFrame:
+    """NYSE sessions in [start, end] as epoch bounds in ``tps`` ticks.
+
+    lo is the 09:29 bar (one minute before the open), hi the last bar before
+    the close, so half-days end at 12:59 instead of 15:59.
+    """
+    per_tick = 10**9 // tps
+    minute = 60 * 10**9
+    return (
+        pl.concat([nyse_year(y) for y in range(start.year, end.year + 1)])
+        .filter(pl.col("trade_date").is_between(start, end))
         .select(
-            pl.col("ticker").str.to_uppercase().alias("symbol"),
-            pl.col("close").cast(pl.Float64).alias("close"),
-            pl.col("window_start").cast(pl.Int64),
+            "trade_date",
+            ((pl.col("open") - minute) // per_tick).alias("lo"),
+            ((pl.col("close") - minute) // per_tick).alias("hi"),
         )
-        .with_columns(ws_ms)
-        .filter(
-            pl.col("ws_ms").is_not_null()
-            & (pl.col("ws_ms") >= MS_MIN)
-            & (pl.col("ws_ms") <= MS_MAX)
+    )
+
+
+SESSION_SCHEMA = {"trade_date": pl.Date, "lo": pl.Int64, "hi": pl.Int64}
+
+
+def rth_bars(paths: list[str], tps: int) -> pl.LazyFrame:
+    """RTH bars of files sharing epoch unit ``tps``, tagged with their session.
+
+    Columns: symbol, close, window_start, trade_date, m (minutes since the
+    09:29 bar).
+    """
+    ws = pl.col("window_start").cast(pl.Int64)
+    sane = ws.is_between(MS_MIN * tps // 1000, MS_MAX * tps // 1000)
+    span = (
+        pl.scan_parquet(paths)
+        .filter(sane)
+        .select(ws.min().alias("a"), ws.max().alias("b"))
+    )
+    a, b = span.collect().row(0)
+    day = 86_400 * tps
+    if a is None:
+        sess = pl.DataFrame(schema=SESSION_SCHEMA)
+    else:
+        sess = sessions(
+            EPOCH_DAY + timedelta(a // day), EPOCH_DAY + timedelta(b // day), tps
+        )
+
+    lf = pl.scan_parquet(paths).select(
+        # cast first: compact poly-fetch output stores ticker as a dictionary
+        pl.col("ticker").cast(pl.Utf8).str.to_uppercase().alias("symbol"),
+        pl.col("close").cast(pl.Float64).alias("close"),
+        ws,
+    )
+    if sess.height == 1:
+        # daily file: the RTH filter is one integer range check
+        d, lo, hi = sess.row(0)
+        lf = lf.filter(ws.is_between(lo, hi)).with_columns(
+            pl.lit(d).alias("trade_date"), pl.lit(lo).alias("lo")
         )
-        .with_columns(
-            [
-                pl.col("ws_ms").cast(pl.Datetime("ms", "UTC")).alias("ts_utc"),
-                pl.col("ws_ms")
-                .cast(pl.Datetime("ms", "UTC"))
-                .dt.convert_time_zone("America/New_York")
-                .alias("ts_ny"),
-            ]
+    else:
+        # RTH bars share their UTC and New York dates
+        lf = (
+            lf.with_columns(
+                (ws // day).cast(pl.Int32).cast(pl.Date).alias("trade_date")
+            )
+            .join(sess.lazy(), on="trade_date")
+            .filter(ws.is_between(pl.col("lo"), pl.col("hi")))
         )
-        # RTH filter with TIME literals
-        .filter(pl.col("ts_ny").dt.time().is_between(pl.time(9, 29), pl.time(15, 59)))
+    m = ((ws - pl.col("lo")) // (60 * tps)).cast(pl.Int32).alias("m")
+    return lf.with_columns(m).drop("lo", "hi", strict=False)
+
+
+def rv_daily(paths, ks=(1, 5, 15, 30)) -> pl.LazyFrame:
+    """Lazy RV per (symbol, trade_date, K) over one or many minute files.
+
+    Files are scanned as one plan (one scan per epoch unit), so a month or
+    a year of days is grouped by trade date in a single query.
+    """
+    paths = [str(p) for p in ([paths] if isinstance(paths, (str, Path)) else paths)]
+    by_unit: dict[int, list[str]] = {}
+    for p in paths:
+        by_unit.setdefault(epoch_unit(p), []).append(p)
+    lf = pl.concat([rth_bars(ps, tps) for tps, ps in sorted(by_unit.items())])
+
+    # 1-minute close grid, built once: m = minutes since the 09:29 bar
+    grid = (
+        lf.group_by(["symbol", "trade_date", "m"])
+        .agg(pl.col("close").sort_by("window_start").last())
+        .sort(["symbol", "trade_date", "m"])
     )
 
-    outs = []
-    ANCHOR = pl.duration(minutes=29)
+    # every minute between a day's first and last bar, close carried forward
+    # (x); bars that traded keep their close, filled minutes have close=null
+    keys = ["symbol", "trade_date"]
+    span = (
+        grid.group_by(keys)
+        .agg(pl.int_ranges(pl.col("m").min(), pl.col("m").max() + 1).alias("m"))
+        .explode("m")
+    )
+    full = span.join(grid, on=[*keys, "m"], how="left").sort([*keys, "m"])
+
+    obs = pl.col("close").is_not_null()
+    close = pl.col("close").filter(obs)
+    m_obs = pl.col("m").filter(obs)
+    x = pl.col("close").log().forward_fill()
+
+    # K-minute buckets start at 09:29 + n*K; a K grid is the strided subset of
+    # traded minutes that close their bucket, so every K comes from one group_by
+    aggs = []
     for K in ks:
-        t_bucket = (
-            (
-                pl.col("ts_ny") - ANCHOR
-            ).dt.truncate(  # shift so 09:29 becomes a “00” boundary
-                f"{K}m"
-            )  # floor to K-min grid
-            + ANCHOR  # shift back → buckets start at 09:29 + n*K
-        ).alias("t_bucket")
-        out = (
-            lf.with_columns([t_bucket])
-            .group_by(["symbol", "t_bucket"])
-            .agg(
-                [
-                    pl.col("close").sort_by(pl.col("ts_ny")).last().alias("close_k"),
-                    pl.col("ts_ny").dt.date().first().alias("trade_date"),
-                ]
-            )
-            .sort(["symbol", "trade_date", "t_bucket"])
-            .with_columns(
-                ((pl.col("close_k") / pl.col("close_k").shift(1)).log())
-                .over(["symbol", "trade_date"])
-                .alias("r")
-            )
-            .group_by(["symbol", "trade_date"])
-            .agg(
-                [
-                    pl.len().alias("n_buckets"),
-                    pl.col("r").count().alias("n_ret"),
-                    (pl.col("r") ** 2).mean().alias("rv"),
-                ]
-            )
-            .with_columns(
-                [
-                    pl.col("rv").sqrt().alias("sigma_daily"),
-                    (pl.col("rv").sqrt() * math.sqrt(252.0 * 24.0 * 60.0 / K)).alias(
-                        "sigma_annualized"
-                    ),
-                    # ( (pl.col("rv") / pl.col("n_ret")) ).sqrt().alias("sigma_daily_std"),
-                    # ( (pl.col("rv") / pl.col("n_ret")).sqrt() * math.sqrt(252.0)).alias("sigma_daily_anualized"),
-                    pl.lit(K).alias("K"),
-                ]
-            )
+        bucket = m_obs // K
+        is_last = (bucket != bucket.shift(-1)).fill_null(True)
+        r = close.filter(is_last).log().diff()
+        # subsampled: the K grids anchored at 09:29+o, o=0..K-1, pooled. Their
+        # full returns are all overlapping K-minute returns of x; the partial
+        # last buckets add (x_T - x_e)^2 for e in (T-K, T). A grid has one
+        # return per traded minute that opens a bucket: sum(min(gap, K)).
+        ss = (x - x.shift(K)).pow(2).sum() + (x.last() - x).pow(2).filter(
+            pl.col("m") > pl.col("m").max() - K
+        ).sum()
+        n_ss = m_obs.diff().clip(upper_bound=K).sum()
+        aggs += [
+            is_last.sum().alias(f"n_buckets_{K}"),
+            r.count().alias(f"n_ret_{K}"),
+            (r**2).mean().alias(f"rv_{K}"),
+            (ss / n_ss).alias(f"rv_ss_{K}"),
+            (math.pi / 2 * (r.abs() * r.abs().shift(1)).mean()).alias(f"bv_{K}"),
+            ((r**4).mean() / 3).alias(f"rq_{K}"),
+        ]
+    daily = full.group_by(keys).agg(aggs)
+
+    # long format: one row per (symbol, trade_date, K)
+    def per_k(name):
+        return pl.concat_list([pl.col(f"{name}_{K}") for K in ks]).alias(name)
+
+    cols = ["n_buckets", "n_ret", "rv", "rv_ss", "bv", "rq"]
+    annual = pl.concat_list([pl.lit(math.sqrt(252.0 * 24.0 * 60.0 / K)) for K in ks])
+    return (
+        daily.select(
+            *keys,
+            *[per_k(c) for c in cols],
+            annual.alias("annual"),
+            pl.concat_list([pl.lit(K, dtype=pl.Int32) for K in ks]).alias("K"),
         )
-        outs.append(out)
+        .explode([*cols, "annual", "K"])
+        .select(
+            *keys,
+            *cols,
+            pl.col("rv").sqrt().alias("sigma_daily"),
+            (pl.col("rv").sqrt() * pl.col("annual")).alias("sigma_annualized"),
+            "K",
+        )
+    )
+
+
+def rv_daily_for_file(path: str, ks=(1, 5, 15, 30)) -> pl.DataFrame:
+    return (
+        rv_daily([path], ks)
+        .collect(engine="streaming")
+        .sort(["K", "symbol", "trade_date"])
+    )
+
 
-    # use streaming engine (new style)
-    return pl.concat(outs).collect(engine="streaming")
+def sink_rv(paths, dst, ks=(1, 5, 15, 30)) -> int:
+    """Stream RV over ``paths`` into one Parquet file; returns its row count."""
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    try:
+        rv_daily(paths, ks).sort(["trade_date", "symbol", "K"]).sink_parquet(tmp)
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return pq.ParquetFile(dst).metadata.num_rows
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+# src/sqlite_util.py
+"""Small SQLite helpers shared by the manifest and the caches."""
+
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def transaction(db: Path, timeout: float = 30):
+    """Connection to ``db`` that commits on success and is always closed."""
+    conn = sqlite3.connect(db, timeout=timeout)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
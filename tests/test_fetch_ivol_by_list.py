@@ -0,0 +1,69 @@
+import sys
+import threading
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import fetch_ivol_by_list as fib
+import ledger
+
+RPS = 20
+
+
+class FakeAPI:
+    """stock-opts-by-param stand-in: one row per business day, call times kept."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, symbol, cp, startDate, endDate, **kw):
+        with self._lock:
+            self.calls.append((time.monotonic(), (symbol, cp, startDate, endDate)))
+        if (symbol, cp, startDate) in self.fail:
+            raise ValueError("boom")
+        days = pd.bdate_range(startDate, endDate)
+        return pd.DataFrame(
+            {
+                "c_date": days.strftime("%Y-%m-%d"),
+                "option_symbol": [f"{symbol}{cp}{d:%Y%m%d}" for d in days],
+                "call_put": cp,
+                "delta": 0.3 if cp == "C" else -0.3,
+            }
+        )
+
+
+def run(tmp_path, monkeypatch, api, *extra):
+    monkeypatch.setattr(fib.ivol, "setLoginParams", lambda **kw: None)
+    monkeypatch.setattr(fib.ivol, "setMethod", lambda path: api)
+    argv = ["fetch", str(tmp_path / "tickers.csv"), "--key", "k"]
+    argv += ["--start", "2024-01-01", "--end", "2024-03-31", "--chunk-days", "31"]
+    argv += ["--outdir", str(tmp_path / "out"), "--retries", "0"]
+    argv += ["--concurrency", "4", "--rps", str(RPS), "--burst", "1", *extra]
+    monkeypatch.setattr(sys, "argv", argv)
+    fib.main()
+
+
+def test_rate_cap_and_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(ledger, "DB", tmp_path / "ledger.sqlite")
+    pd.DataFrame({"symbol": ["AAA", "BBB"]}).to_csv(tmp_path / "tickers.csv")
+
+    first = FakeAPI(fail={("AAA", "P", "2024-02-01")})
+    run(tmp_path, monkeypatch, first)
+    times = sorted(t for t, _ in first.calls)
+    assert len(times) == 12  # 2 symbols x C/P x 3 monthly chunks
+    # 4 workers, but no faster than --rps after the single banked token
+    assert times[-1] - times[0] >= 0.9 * (len(times) - 1) / RPS
+
+    second = FakeAPI()
+    run(tmp_path, monkeypatch, second, "--resume")
+    assert [unit for _, unit in second.calls] == [
+        ("AAA", "P", "2024-02-01", "2024-03-02")
+    ]
+
+    out = next((tmp_path / "out").glob("ivol_AAA_*.parquet"))
+    df = pq.read_table(out).to_pandas()
+    assert len(df) == 2 * len(pd.bdate_range("2024-01-01", "2024-03-31"))
+    assert not df.duplicated(["option_symbol"]).any()
@@ -0,0 +1,100 @@
+import io
+
+import pytest
+
+from flatfile_cache import FlatfileCache, NotCached
+
+
+class NoSuchKey(Exception):
+    def __init__(self, response, op):
+        super().__init__(op)
+        self.response = response
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client (head/get only)."""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def put(self, key, data: bytes, etag: str):
+        self.objects[key] = (data, f'"{etag}"')
+
+    def _obj(self, key):
+        if key not in self.objects:
+            raise NoSuchKey({"Error": {"Code": "404"}}, "HeadObject")
+        return self.objects[key]
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": self._obj(Key)[1]}
+
+    def get_object(self, Bucket, Key):
+        data, etag = self._obj(Key)
+        self.gets += 1
+        return {"ETag": etag, "Body": io.BytesIO(data)}
+
+
+def read(cache, s3, key, **kw):
+    fh, etag = cache.open(s3, "b", key, **kw)
+    with fh:
+        return fh.read(), etag
+
+
+def test_hit_skips_download(tmp_path):
+    s3 = FakeS3()
+    s3.put("a", b"aaaa", "e1")
+    cache = FlatfileCache(tmp_path)
+    assert read(cache, s3, "a") == (b"aaaa", "e1")
+    assert read(cache, s3, "a") == (b"aaaa", "e1")
+    assert s3.gets == 1
+
+
+def test_new_etag_replaces_blob(tmp_path):
+    s3 = FakeS3()
+    s3.put("a", b"old", "e1")
+    cache = FlatfileCache(tmp_path)
+    read(cache, s3, "a")
+    old = cache.lookup("b", "a", "e1")
+
+    s3.put("a", b"new", "e2")
+    assert read(cache, s3, "a") == (b"new", "e2")
+    assert s3.gets == 2
+    assert cache.lookup("b", "a", "e1") is None and not old.exists()
+    assert cache.stats() == (1, 3)
+
+
+def test_lru_eviction(tmp_path):
+    s3 = FakeS3()
+    for k in "abc":
+        s3.put(k, k.encode() * 10, k)
+    cache = FlatfileCache(tmp_path, max_bytes=25)
+    read(cache, s3, "a")
+    read(cache, s3, "b")
+    read(cache, s3, "a")  # touch a so b is least recently used
+    read(cache, s3, "c")
+
+    assert cache.lookup("b", "b") is None
+    assert cache.lookup("b", "a") is not None
+    assert cache.lookup("b", "c") is not None
+    assert cache.stats() == (2, 20)
+
+
+def test_offline(tmp_path):
+    s3 = FakeS3()
+    s3.put("a", b"aaaa", "e1")
+    cache = FlatfileCache(tmp_path)
+    read(cache, s3, "a")
+
+    s3.objects.clear()  # offline must not touch S3
+    assert read(cache, None, "a", offline=True) == (b"aaaa", "e1")
+    with pytest.raises(NotCached):
+        read(cache, None, "missing", offline=True)
+
+
+def test_missing_key(tmp_path):
+    with pytest.raises(NoSuchKey):
+        read(FlatfileCache(tmp_path), FakeS3(), "nope")
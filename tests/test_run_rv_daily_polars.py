@@ -0,0 +1,84 @@
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import polars as pl
+
+SCRIPT = Path(__file__).resolve().parents[1] / "scripts" / "run_rv_daily_polars.py"
+NY = ZoneInfo("America/New_York")
+
+
+def write_day(raw: Path, day: str):
+    rng = np.random.default_rng(int(day.replace("-", "")))
+    start = datetime.fromisoformat(f"{day}T09:00").replace(tzinfo=NY)
+    ts = [int((start + timedelta(minutes=i)).timestamp()) * 10**9 for i in range(480)]
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 1e-3, len(ts))))
+    pl.DataFrame({"ticker": "AAA", "window_start": ts, "close": close}).write_parquet(
+        raw / f"{day}_spx_1m.parquet"
+    )
+
+
+def run(raw: Path, out: Path, *extra):
+    cmd = [sys.executable, str(SCRIPT), "*_spx_1m.parquet", "--out", str(out)]
+    cmd += ["--workers", "1", "--group", "month", *extra]
+    subprocess.run(cmd, check=True, capture_output=True, cwd=raw)
+
+
+def test_partial_range_keeps_other_days_of_the_period(tmp_path):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    write_day(raw, "2024-03-05")
+    run(raw, out)
+    period = out / "year=2024" / "rv_2024-03.parquet"
+    assert pl.read_parquet(period)["trade_date"].unique().len() == 1
+
+    # a new day arrives and only it is requested: the month is rebuilt whole
+    write_day(raw, "2024-03-06")
+    run(raw, out, "--start", "2024-03-06")
+    days = sorted(pl.read_parquet(period)["trade_date"].unique().cast(str))
+    assert days == ["2024-03-05", "2024-03-06"]
+
+
+def test_rebuilt_day_is_not_stored_twice(tmp_path):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    for day in ("2024-03-05", "2024-03-06"):
+        write_day(raw, day)
+    cmd = [sys.executable, str(SCRIPT), "*_spx_1m.parquet", "--out", str(out)]
+    cmd += ["--workers", "1"]
+    subprocess.run([*cmd, "--compact", "month"], check=True, cwd=raw)
+    subprocess.run([*cmd, "--overwrite", "--start", "2024-03-06"], check=True, cwd=raw)
+
+    files = sorted(out.rglob("*.parquet"))
+    df = pl.concat([pl.read_parquet(f) for f in files], how="diagonal_relaxed")
+    assert not df.select(["symbol", "trade_date", "K"]).is_duplicated().any()
+    assert df["trade_date"].n_unique() == 2
+    # the period file's manifest entries were re-hashed after the eviction
+    done = subprocess.run(
+        [*cmd, "--verify"], check=True, cwd=raw, capture_output=True, text=True
+    )
+    assert "[sync] 2 of 2 outputs up to date" in done.stdout
+
+
+def test_group_run_replaces_daily_outputs(tmp_path):
+    raw, out = tmp_path / "raw", tmp_path / "out"
+    raw.mkdir()
+    for day in ("2024-03-05", "2024-03-06"):
+        write_day(raw, day)
+    cmd = [sys.executable, str(SCRIPT), "*_spx_1m.parquet", "--out", str(out)]
+    cmd += ["--workers", "1"]
+    subprocess.run(cmd, check=True, capture_output=True, cwd=raw)
+    assert len(list(out.glob("all_min*.parquet"))) == 2
+
+    run(raw, out)
+    files = sorted(out.rglob("*.parquet"))
+    assert files == [out / "year=2024" / "rv_2024-03.parquet"]
+    df = pl.read_parquet(files[0])
+    assert not df.select(["symbol", "trade_date", "K"]).is_duplicated().any()
+    assert df["trade_date"].n_unique() == 2
+    # the per-day parts are gone, so a per-file run rebuilds those days
+    done = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=raw)
+    assert "[sync] 0 of 2 outputs up to date" in done.stdout